@@ -1,114 +1,143 @@
 from __future__ import annotations
 from argparse import Namespace
-from typing import Any
+from typing import Any, Optional
+import contextlib
+import hashlib
+import os
 import pathlib
-import json
+import sqlite3
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor, as_completed
 from math import ceil
 from appdirs import AppDirs
 import requests
-from util import Config, read_package_data, size_fmt, proceed_menu
+import pkgdb
+import store
+import transport
+from output import RecordWriter
+from util import Config, Package, read_packages, size_fmt, proceed_menu
 
 
 def run(args: Namespace, config: Config, appdirs: AppDirs):
     if len(args.pkg_name) == 0 and not args.all:
         raise Exception("Must include at least 1 package to fetch.")
 
-    if args.all:
+    # Machine readable output only lists the packages that would be fetched,
+    # nothing is downloaded.
+    planning: bool = args.format != 'text'
+
+    if args.all and not planning:
         if not proceed_menu('Fetching all packages is heavily discouraged,\
  continue?'):
             return
 
-    if not args.destdir:
+    if not args.destdir and not planning:
         print('No output directory chosen, files will be downloaded to\n\t',
-              f'{appdirs.user_cache_dir}')
+              f'{config.get_catalogue_dir(appdirs)}')
 
     pkg_list, full_size = process_package_list(args, appdirs, config)
 
+    if planning:
+        with RecordWriter(args.format, SUMMARY_FIELDS) as writer:
+            for pkg in pkg_list:
+                writer.write({field: getattr(pkg, field)
+                              for field in SUMMARY_FIELDS})
+        return
+
     if pre_download(pkg_list, full_size):
-        try:
-            download_packages(pkg_list, args, config, appdirs)
-        except requests.HTTPError:
-            print('Unable to read package, try updating your package database.')
+        download_packages(pkg_list, args, config, appdirs)
 
 
 def process_package_list(args: Namespace, appdirs: AppDirs,
-                         config: Config) -> tuple[list[dict[str, Any]], int]:
+                         config: Config) -> tuple[list[Package], int]:
     if args.all:
-        return get_all_packages(appdirs)
-
-    pkg_list: list[dict[str, Any]] = []
-    full_size: int = 0
-    for pkg_name in args.pkg_name:
-        pkg_full = read_package_data(pkg_name, config, appdirs)
-        pkg_list.append({
-            'name': pkg_full['name'],
-            'version': pkg_full['version'],
-            'pkgsize': pkg_full['pkgsize']
-        })
-
-        if args.dependencies and pkg_full.get('deps', None):
-            deps = pkg_full['deps'].keys()
-            pkgs = resolve_deps(deps, appdirs, config)
-            pkg_list.extend(pkgs)
-
-    # Calculate full size and generate a unique list of packages.
-    included_pkgs: list[str] = []
-    for pkg in pkg_list.copy():
-        if pkg['name'] in included_pkgs:
-            pkg_list.remove(pkg)
-            continue
+        return get_all_packages(config, appdirs)
 
-        included_pkgs.append(pkg['name'])
-        full_size += pkg['pkgsize']
+    if args.dependencies:
+        pkg_list = resolve_deps(args.pkg_name, appdirs, config)
+    else:
+        pkg_list = get_package_summaries(args.pkg_name, config, appdirs)
 
-    pkg_list = sorted(pkg_list, key=lambda data: data['name'])
+    full_size: int = sum(pkg.pkgsize for pkg in pkg_list)
+    pkg_list = sorted(pkg_list, key=lambda pkg: pkg.name)
 
     return pkg_list, full_size
 
 
-def resolve_deps(deps_list: list[str], appdirs: AppDirs,
-                 config: Config) -> list[dict[str, Any]]:
-    ''' Get the fully resolved list of dependencies (recursive).'''
-    pkg_list: list[dict[str, Any]] = []
+def resolve_deps(roots: list[str], appdirs: AppDirs,
+                 config: Config) -> list[Package]:
+    '''Get the packages in roots along with all of their dependencies.
 
-    for dep_name in deps_list:
-        pkg = read_package_data(dep_name, config, appdirs)
-        pkg_list.append({
-            'name': pkg['name'],
-            'version': pkg['version'],
-            'pkgsize': pkg['pkgsize']
-        })
+    The dependency graph is walked depth-first without recursion, and every
+    package is visited only once no matter how many packages depend on it.
+    The closure is returned in topological order, every package comes after
+    all of its dependencies.
+    '''
+    conn = pkgdb.connect(config.get_catalogue_dir(appdirs))
+    closure: list[str] = []
+    visited: set[str] = set()
 
-        if pkg.get('deps', None):
-            deps = resolve_deps(pkg['deps'].keys(), appdirs, config)
-            pkg_list.extend([d for d in deps if d not in pkg_list])
+    for root in roots:
+        if root in visited:
+            continue
+        visited.add(root)
 
-    return pkg_list
+        stack = [(root, iter(get_dependency_names(conn, root)))]
+        while stack:
+            pkg_name, deps = stack[-1]
+            for dep_name in deps:
+                if dep_name not in visited:
+                    visited.add(dep_name)
+                    stack.append((dep_name,
+                                  iter(get_dependency_names(conn, dep_name))))
+                    break
+            else:
+                # Every dependency has been added, so this package can be.
+                stack.pop()
+                closure.append(pkg_name)
 
+    return get_package_summaries(closure, config, appdirs)
 
-def get_all_packages(appdirs: AppDirs) -> tuple[list[dict[str, Any]], int]:
-    pkg_list: list[dict[str, Any]] = []
-    full_size: int = 0
 
-    with open(pathlib.Path(appdirs.user_cache_dir, 'pkgdb.yaml'), 'r') as f:
-        for line in f.readlines():
-            pkg_data = json.loads(line)
-            pkg_list.append({
-                'name': pkg_data['name'],
-                'version': pkg_data['version'],
-                'pkgsize': pkg_data['pkgsize']
-            })
+# The only fields needed to plan and download a fetch.
+SUMMARY_FIELDS = ['name', 'version', 'pkgsize', 'sum']
 
-            full_size += pkg_data['pkgsize']
+
+def get_all_packages(config: Config,
+                     appdirs: AppDirs) -> tuple[list[Package], int]:
+    pkg_list = read_packages(None, SUMMARY_FIELDS, config, appdirs)
+    full_size: int = sum(pkg.pkgsize for pkg in pkg_list)
 
     return pkg_list, full_size
 
 
-def download_packages(pkg_list: list[dict[str, Any]], args: Namespace,
+def get_package_summaries(pkg_names: list[str], config: Config,
+                          appdirs: AppDirs) -> list[Package]:
+    '''Return the name, version, size and checksum of packages.'''
+    pkg_list = read_packages(pkg_names, SUMMARY_FIELDS, config, appdirs)
+    if len(pkg_list) != len(set(pkg_names)):
+        found = {pkg.name for pkg in pkg_list}
+        unknown = [name for name in pkg_names if name not in found]
+        raise Exception(f'Unknown package(s): {", ".join(unknown)}')
+
+    return pkg_list
+
+
+def get_dependency_names(conn: sqlite3.Connection,
+                         pkg_name: str) -> list[str]:
+    rows = conn.execute('SELECT name FROM deps WHERE package = ?',
+                        (pkg_name,))
+
+    return [row[0] for row in rows]
+
+
+def download_packages(pkg_list: list[Package], args: Namespace,
                       config: Config, appdirs: AppDirs):
-    # First find the download location.
-    out_path: pathlib.Path = pathlib.Path(appdirs.user_cache_dir)
+    # First find the download location, packages are kept alongside the
+    # catalogue they came from by default.
+    out_path: pathlib.Path = config.get_catalogue_dir(appdirs)
 
     if args.destdir:
         out_path = pathlib.Path(args.destdir)
@@ -117,37 +146,324 @@ def download_packages(pkg_list: list[dict[str, Any]], args: Namespace,
         if not out_path.exists():
             out_path.mkdir()
 
+    store_dir = store.get_store_dir(appdirs)
+    pending: list[tuple[Package, pathlib.Path]] = []
+    downloaded: list[tuple[Package, pathlib.Path]] = []
     for pkg in pkg_list:
-        # Prepare the package's location to be passed to the URL.
-        pkg_name_version = f'{pkg["name"]}-{pkg["version"]}'
-        pkg_location: str = f'{pkg_name_version}.pkg'
-        pkg_path = pathlib.Path(out_path, pkg_location)
+        pkg_path = pathlib.Path(out_path, f'{pkg.name}-{pkg.version}.pkg')
 
         # Do not download if the file exists.
-        if check_downloaded_package(pkg_path, pkg['pkgsize']):
-            print(f'Skipping downloaded package: {pkg_location}')
+        if check_downloaded_package(pkg_path, pkg.pkgsize):
+            downloaded.append((pkg, pkg_path))
             continue
 
-        # Prepare download stats
-        download_size = 0
-        start_time = time.perf_counter()
-
-        print_status(pkg_name_version)
-
-        # Actually download the thing.
-        with requests.get(config.get_full_url().format(pkg_location)) as r:
-            r.raise_for_status()
-
-            with open(pkg_path, 'wb') as f:
-                for chunk in r.iter_content():
-                    if chunk:
-                        f.write(chunk)
-                        download_size += len(chunk)
-                    elapsed = round(time.perf_counter() - start_time)
-                    print_status(pkg_name_version,
-                                 ceil(download_size / pkg['pkgsize'] * 100),
-                                 download_size, elapsed)
-                print()  # Newline to prevent overwriting the previous output.
+        pending.append((pkg, pkg_path))
+
+    if args.verify_existing and downloaded:
+        discard_damaged(downloaded, pending, store_dir)
+
+    for _, pkg_path in downloaded:
+        print(f'Skipping downloaded package: {pkg_path.name}')
+
+    if args.store_size is not None:
+        config.store_bytes = args.store_size * 1024 * 1024
+    fetches = link_stored(pending, store_dir,
+                          store.can_link(store_dir, out_path))
+    if fetches:
+        fetch_packages(fetches, args, config)
+
+    store.collect_garbage(store_dir, config.store_bytes)
+
+
+def discard_damaged(downloaded: list[tuple[Package, pathlib.Path]],
+                    pending: list[tuple[Package, pathlib.Path]],
+                    store_dir: pathlib.Path):
+    '''Move downloaded packages not matching their checksum to pending.
+
+    Their files are removed, along with the stored package they are linked
+    to.
+    '''
+    print(f'Verifying {len(downloaded)} downloaded package(s)...')
+    for pkg, pkg_path in verify_packages(downloaded):
+        print(f'Checksum mismatch, fetching again: {pkg_path.name}')
+        stored = store.get_path(store_dir, pkg.sum)
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        with store.lock(stored):
+            if stored.exists() and stored.samefile(pkg_path):
+                # A link to the stored package, which is damaged as well.
+                stored.unlink()
+        pkg_path.unlink()
+        downloaded.remove((pkg, pkg_path))
+        pending.append((pkg, pkg_path))
+
+
+def link_stored(pending: list[tuple[Package, pathlib.Path]],
+                store_dir: pathlib.Path, linkable: bool
+                ) -> list[tuple[Package, pathlib.Path, Optional[pathlib.Path]]]:
+    '''Link packages already in the store, returning those left to fetch.
+
+    Packages are downloaded into the shared store and linked to their path
+    from there. Packages without a checksum cannot be stored and are
+    downloaded directly, as is everything when the store cannot be linked
+    from, see store.can_link. Each package to fetch comes with its store
+    path, if any.
+    '''
+    fetches: list[tuple[Package, pathlib.Path, Optional[pathlib.Path]]] = []
+    for pkg, pkg_path in pending:
+        stored = store.get_path(store_dir, pkg.sum) if pkg.sum else None
+        if stored and check_downloaded_package(stored, pkg.pkgsize):
+            try:
+                store.link(stored, pkg_path)
+            except FileNotFoundError:
+                # Removed from the store by another spkg in the meantime.
+                pass
+            else:
+                print(f'Linking stored package: {pkg_path.name}')
+                continue
+        if not linkable:
+            stored = None
+        if stored:
+            stored.parent.mkdir(parents=True, exist_ok=True)
+        fetches.append((pkg, pkg_path, stored))
+
+    return fetches
+
+
+def fetch_packages(fetches: list[tuple[Package, pathlib.Path,
+                                       Optional[pathlib.Path]]],
+                   args: Namespace, config: Config):
+    '''Download packages concurrently, placing each one at its path.
+
+    Packages with a store path are downloaded into the store first.
+    '''
+    # Keep a pooled connection around for every worker.
+    config.pool_size = max(config.pool_size, args.jobs)
+    if args.chunk_size:
+        config.chunk_size = args.chunk_size * 1024
+    if args.limit_rate:
+        config.rate_limit = args.limit_rate * 1024
+    if args.host_jobs:
+        config.host_connections = args.host_jobs
+
+    limiter = transport.TokenBucket(config.rate_limit) \
+        if config.rate_limit else None
+    progress = Progress(len(fetches),
+                        sum(pkg.pkgsize for pkg, _, _ in fetches), limiter)
+    failed: list[tuple[str, Exception]] = []
+
+    # Workers take packages in the order they are submitted. Starting with
+    # the largest keeps a few big packages from being left for last, while
+    # the small ones fill in around them.
+    fetches = sorted(fetches, key=lambda fetch: fetch[0].pkgsize,
+                     reverse=True)
+
+    progress.render()
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        futures: dict[Future[None], str] = {}
+        for pkg, pkg_path, stored in fetches:
+            name = f'{pkg.name}-{pkg.version}'
+            futures[pool.submit(fetch_package, pkg, pkg_path, stored, config,
+                                progress)] = name
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (requests.RequestException, OSError, DownloadError) as e:
+                failed.append((futures[future], e))
+            progress.finish_package()
+    progress.render()
+    print()  # Newline to prevent overwriting the progress output.
+
+    if failed:
+        print(f'Unable to fetch {len(failed)} package(s), try updating your\
+ package database:')
+        for name, error in sorted(failed, key=lambda fail: fail[0]):
+            print(f'\t{name}: {error}')
+
+
+def fetch_package(pkg: Package, pkg_path: pathlib.Path,
+                  stored: Optional[pathlib.Path], config: Config,
+                  progress: Progress):
+    if stored is None:
+        download_package(pkg, pkg_path, config, progress)
+        return
+
+    # Other spkg processes fetching the same package wait here, then find it
+    # stored already rather than writing to the same .part file.
+    with store.lock(stored):
+        if check_downloaded_package(stored, pkg.pkgsize):
+            progress.resume(pkg.pkgsize)
+        else:
+            download_package(pkg, stored, config, progress)
+        store.link(stored, pkg_path)
+
+
+def download_package(pkg: Package, pkg_path: pathlib.Path,
+                     config: Config, progress: Progress):
+    '''Download a single package, resuming any earlier partial download.
+
+    Data is written to a .part file next to pkg_path, which is only moved
+    into place once its size and SHA-256 checksum match the catalogue.
+    '''
+    part_path = pathlib.Path(pkg_path.parent, pkg_path.name + '.part')
+
+    offset: int = part_path.stat().st_size if part_path.exists() else 0
+    if offset > pkg.pkgsize:
+        # Left over from a different build of the package.
+        offset = 0
+
+    if offset < pkg.pkgsize:
+        url = config.get_full_url().format(f'{pkg.name}-{pkg.version}.pkg')
+        offset, checksum = download_range(url, part_path, offset, config,
+                                          progress)
+    else:
+        checksum = hashlib.sha256()
+        hash_file(part_path, checksum)
+        progress.resume(offset)
+
+    size = part_path.stat().st_size
+    if size != pkg.pkgsize:
+        # Short downloads are kept to be resumed on the next fetch.
+        if size > pkg.pkgsize:
+            part_path.unlink()
+        raise DownloadError(f'expected {pkg.pkgsize} bytes but received\
+ {size}')
+
+    if pkg.sum and checksum.hexdigest() != pkg.sum:
+        part_path.unlink()
+        if offset:
+            # The part downloaded earlier may be at fault, start over once.
+            progress.resume(-size)
+            download_package(pkg, pkg_path, config, progress)
+            return
+        raise DownloadError('checksum does not match the package database')
+
+    os.replace(part_path, pkg_path)
+
+
+def download_range(url: str, part_path: pathlib.Path, offset: int,
+                   config: Config, progress: Progress) -> tuple[int, Any]:
+    '''Download url into part_path, asking for the data from offset on.
+
+    The first offset bytes of part_path are kept if the server sends just
+    the rest, otherwise the whole file is written again. The checksum is
+    calculated as the data arrives. Returns the offset the data was
+    written from and the SHA-256 checksum of all of part_path.
+    '''
+    checksum = hashlib.sha256()
+    headers: dict[str, str] = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+
+    with transport.host_slot(config, url) or contextlib.nullcontext(), \
+            transport.get(config, url, headers=headers, stream=True) as r:
+        if r.status_code == requests.codes.range_not_satisfiable:
+            part_path.unlink()
+        r.raise_for_status()
+
+        # Servers ignoring the range send the whole file again.
+        if r.status_code != requests.codes.partial_content:
+            offset = 0
+        elif offset:
+            hash_file(part_path, checksum)
+        progress.resume(offset)
+
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(config.chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    progress.advance(len(chunk))
+
+    return offset, checksum
+
+
+def verify_packages(packages: list[tuple[Package, pathlib.Path]]
+                    ) -> list[tuple[Package, pathlib.Path]]:
+    '''Return the packages whose files do not match their checksum.
+
+    Files are hashed in parallel, one process per core.
+    '''
+    with ProcessPoolExecutor() as pool:
+        sums = pool.map(hash_file, [pkg_path for _, pkg_path in packages],
+                        chunksize=8)
+
+        return [(pkg, pkg_path) for (pkg, pkg_path), digest
+                in zip(packages, sums) if pkg.sum and digest != pkg.sum]
+
+
+def hash_file(path: pathlib.Path, checksum: Any = None) -> str:
+    '''Feed the contents of a file into checksum (SHA-256 by default).'''
+    if checksum is None:
+        checksum = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Progress():
+    '''Aggregate download progress shared by every download worker.
+
+    Workers only update the counters, the status line itself is redrawn at
+    most REFRESH_RATE times a second. Data resumed from earlier downloads
+    counts towards the progress but not towards the speed and time left.
+    With a limiter, workers advancing the progress wait for the limiter to
+    allow the data they received, limiting the combined download speed.
+    '''
+    REFRESH_RATE = 10
+
+    def __init__(self, pkg_count: int, total_size: int,
+                 limiter: Optional[transport.TokenBucket] = None):
+        self.pkg_count = pkg_count
+        self.total_size = total_size
+        self.pkgs_done: int = 0
+        self.downloaded: int = 0
+        self.resumed: int = 0
+        self.start_time = time.perf_counter()
+        self.limiter = limiter
+        self._next_render: float = 0
+        self._lock = threading.Lock()
+
+    def advance(self, amount: int):
+        with self._lock:
+            self.downloaded += amount
+            self._maybe_render()
+        if self.limiter:
+            self.limiter.consume(amount)
+
+    def resume(self, amount: int):
+        with self._lock:
+            self.downloaded += amount
+            self.resumed += amount
+            self._maybe_render()
+
+    def finish_package(self):
+        with self._lock:
+            self.pkgs_done += 1
+            self._maybe_render()
+
+    def _maybe_render(self):
+        now = time.perf_counter()
+        if now >= self._next_render:
+            self._next_render = now + 1 / self.REFRESH_RATE
+            self.render()
+
+    def render(self):
+        percent = ceil(self.downloaded / self.total_size * 100) \
+            if self.total_size else 100
+        elapsed = time.perf_counter() - self.start_time
+        speed = (self.downloaded - self.resumed) / elapsed if elapsed else 0
+        time_left = round((self.total_size - self.downloaded) / speed) \
+            if speed else None
+        print_status(self.pkgs_done, self.pkg_count, percent, self.downloaded,
+                     round(elapsed), speed, time_left)
 
 
 def check_downloaded_package(location: pathlib.Path, pkg_size: int, ) -> bool:
@@ -162,12 +478,12 @@ def check_downloaded_package(location: pathlib.Path, pkg_size: int, ) -> bool:
     return fully_downloaded
 
 
-def pre_download(pkg_list: list[dict[str, Any]], total_size: int) -> bool:
+def pre_download(pkg_list: list[Package], total_size: int) -> bool:
     out = 'The following packages will be fetched:\n'
     for pkg in pkg_list:
-        name: str = pkg['name']
-        version: str = pkg['version']
-        size: int = pkg['pkgsize']
+        name: str = pkg.name
+        version: str = pkg.version
+        size: int = pkg.pkgsize
         percent_total: float = (size / total_size) * 100
         out += f'\t{name}: {version} ({size_fmt(size, do_round=True)}:\
  {round(percent_total,2)}% of the {size_fmt(total_size, do_round=True)} to\
@@ -185,16 +501,24 @@ def pre_download(pkg_list: list[dict[str, Any]], total_size: int) -> bool:
     return True
 
 
-def print_status(pkg_name_ver: str, percent_downloaded: int = 0,
-                 amount_downloaded: int = 0, time_elapsed: float = 0):
-
-    # Calculate download speed.
-    speed = amount_downloaded / time_elapsed if time_elapsed else 0
+def print_status(pkgs_done: int, pkg_count: int, percent_downloaded: int = 0,
+                 amount_downloaded: int = 0, time_elapsed: int = 0,
+                 speed: float = 0, time_left: Optional[int] = None):
 
-    # Calculate time elapsed as human-readable.
-    elapsed_min, elapsed_sec = divmod(time_elapsed, 60)
-    time_out = f'{elapsed_min:02d}:{elapsed_sec:02d}'
+    # Calculate time elapsed and time left as human-readable.
+    time_out = fmt_time(time_elapsed)
+    eta_out = fmt_time(time_left) if time_left is not None else '--:--'
 
-    print(f'Fetching {pkg_name_ver}: {percent_downloaded:3}%  \
+    print(f'Fetched {pkgs_done}/{pkg_count} packages: {percent_downloaded:3}%  \
 {size_fmt(amount_downloaded, do_round=True):8} \
-{size_fmt(speed, do_round=False)+"/s":11} {time_out:5}', end='\r')
+{size_fmt(speed, do_round=False)+"/s":11} {time_out:5} ETA {eta_out:8}',
+          end='\r')
+
+
+def fmt_time(seconds: int) -> str:
+    minutes, seconds = divmod(seconds, 60)
+    if minutes >= 60:
+        hours, minutes = divmod(minutes, 60)
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+    return f'{minutes:02d}:{seconds:02d}'
@@ -1,77 +1,204 @@
 from __future__ import annotations
 from typing import Any, Union
 from argparse import Namespace
+import sys
 from appdirs import AppDirs
-from util import Config, read_package_data, size_fmt
+import pkgdb
+from output import RecordWriter
+from util import Config, Package, iter_packages, size_fmt
 
 
 def run(args: Namespace, config: Config, appdirs: AppDirs):
     packages = args.pkg_name
-    if args.full:
-        for package in packages:
-            data = read_package_data(package, config, appdirs)
-            print_full(data)
-        return
+    if not packages and not args.stdin:
+        raise Exception('Must include at least 1 package.')
 
-    for package in packages:
-        pkg_data = read_package_data(package, config, appdirs)
-        print_data(pkg_data, args)
+    # Batches from stdin are read in a single pass through pkgdb.yaml, each
+    # package is printed as soon as it has been read.
+    found: set[str] = set()
+    if args.full:
+        if args.format != 'text':
+            found = write_full(packages, args, config, appdirs)
+        else:
+            for pkg in iter_packages(packages, None, config, appdirs,
+                                     by_offset=args.stdin):
+                found.add(pkg.name)
+                print_full(pkg)
+    else:
+        # Only read the fields that will be displayed.
+        fields: list[str] = ['name', 'version']
+        for option, field in DATA_FIELDS.items():
+            if getattr(args, option):
+                fields.append(field)
+
+        if args.format != 'text':
+            found = write_data(packages, fields, args, config, appdirs)
+        else:
+            for pkg in iter_packages(packages, fields, config, appdirs,
+                                     by_offset=args.stdin):
+                found.add(pkg.name)
+                print_data(pkg, args, config, appdirs)
+
+    # Reported once the known packages have been printed, so a typo in a
+    # batch does not hold back the rest of it.
+    unknown = [name for name in dict.fromkeys(packages) if name not in found]
+    if unknown:
+        print(f'Unknown package(s): {", ".join(unknown)}', file=sys.stderr)
+        sys.exit(1)
+
+
+# The package field displayed by each of print_data's options.
+DATA_FIELDS = {
+    'origin': 'origin',
+    'prefix': 'prefix',
+    'comment': 'comment',
+    'required_shlibs': 'shlibs_required',
+    'provided_shlibs': 'shlibs_provided',
+    'annotations': 'annotations',
+    'size': 'flatsize',
+    'pkg_message': 'messages',
+    'dependencies': 'deps',
+    'resolve_shlibs': 'shlibs_required'
+}
+
+
+# The fields of a full record written as TSV, in the order of print_full.
+FULL_COLUMNS = ['name', 'version', 'origin', 'abi', 'prefix', 'categories',
+                'licenses', 'maintainer', 'www', 'comment', 'flatsize', 'desc']
+
+
+def write_full(packages: list[str], args: Namespace, config: Config,
+               appdirs: AppDirs) -> set[str]:
+    '''Write the full records of packages in a machine readable format.
+
+    JSON output is copied straight from pkgdb.yaml. Returns the names of the
+    packages written.
+    '''
+    db_dir = config.get_catalogue_dir(appdirs)
+    found: set[str] = set()
+    with RecordWriter(args.format, FULL_COLUMNS) as writer:
+        for name, line in pkgdb.read_raw(db_dir, packages,
+                                         by_offset=args.stdin):
+            found.add(name)
+            writer.write_raw(line)
+
+    return found
+
+
+def write_data(packages: list[str], fields: list[str], args: Namespace,
+               config: Config, appdirs: AppDirs) -> set[str]:
+    '''Write the fields print_data would display, machine readable.
+
+    Packages requiring the package and the providers of its shared
+    libraries are listed by name and version. Returns the names of the
+    packages written.
+    '''
+    fields = list(dict.fromkeys(fields))
+    required_by = args.required_by or args.required_by_recursive
+    columns = list(fields)
+    if required_by:
+        columns.append('required_by')
+    if args.resolve_shlibs:
+        columns.append('shlib_providers')
+    conn = pkgdb.connect(config.get_catalogue_dir(appdirs))
+    found: set[str] = set()
+
+    with RecordWriter(args.format, columns) as writer:
+        for pkg in iter_packages(packages, fields, config, appdirs,
+                                 by_offset=args.stdin):
+            found.add(pkg.name)
+            record: dict[str, Any] = {field: getattr(pkg, field, None)
+                                      for field in fields}
+            if required_by:
+                record['required_by'] = [
+                    {'name': name, 'version': version} for name, version
+                    in pkgdb.get_required_by(conn, pkg.name,
+                                             args.required_by_recursive)]
+            if args.resolve_shlibs:
+                record['shlib_providers'] = {
+                    lib: [{'name': name, 'version': version}
+                          for name, version in providers]
+                    for lib, providers in pkgdb.get_providers(
+                        conn, pkg.shlibs_required or []).items()}
+            writer.write(record)
+
+    return found
 
 
 # pylint: disable=too-many-branches
-def print_data(pkg_data: dict[str, Any], args: Namespace):
-    out = ''
+def print_data(pkg: Package, args: Namespace, config: Config,
+               appdirs: AppDirs):
+    out: list[str] = []
     FMT_STR = '{:15}: {}\n'
     SUB_FMT_STR = '\t{}\n'
 
-    out += f'{pkg_data["name"]}-{pkg_data["version"]}\n'
+    out.append(f'{pkg.name}-{pkg.version}\n')
 
     if args.origin:
-        out += FMT_STR.format('Origin', pkg_data['origin'])
+        out.append(FMT_STR.format('Origin', pkg.origin))
 
     if args.prefix:
-        out += FMT_STR.format('Prefix', pkg_data['prefix'])
+        out.append(FMT_STR.format('Prefix', pkg.prefix))
 
     if args.comment:
-        out += FMT_STR.format('Comment', pkg_data['comment'])
+        out.append(FMT_STR.format('Comment', pkg.comment))
 
     if args.required_shlibs:
-        if pkg_data.get('shlibs_required', None):
-            out += 'Shared Libs required:\n'
-            for lib in pkg_data['shlibs_required']:
-                out += SUB_FMT_STR.format(lib)
+        if pkg.shlibs_required:
+            out.append('Shared Libs required:\n')
+            for lib in pkg.shlibs_required:
+                out.append(SUB_FMT_STR.format(lib))
+
+    if args.resolve_shlibs:
+        if pkg.shlibs_required:
+            conn = pkgdb.connect(config.get_catalogue_dir(appdirs))
+            out.append('Shared Libs required, and the packages providing\
+ them:\n')
+            for lib, providers in pkgdb.get_providers(
+                    conn, pkg.shlibs_required).items():
+                out.append(SUB_FMT_STR.format(lib))
+                for pkg_name, version in providers:
+                    out.append(f'\t\t{pkg_name}-{version}\n')
+                if not providers:
+                    out.append('\t\tNot provided by any package\n')
 
     if args.provided_shlibs:
-        if pkg_data.get('shlibs_provided', None):
-            out += 'Shared Libs provided:\n'
-            for lib in pkg_data['shlibs_provided']:
-                out += SUB_FMT_STR.format(lib)
+        if pkg.shlibs_provided:
+            out.append('Shared Libs provided:\n')
+            for lib in pkg.shlibs_provided:
+                out.append(SUB_FMT_STR.format(lib))
 
     if args.annotations:
-        if pkg_data.get('annotations', None):
-            out += FMT_STR.format('Annotations', '')
-            for key, value in pkg_data['annotations'].items():
-                out += f'\t{key:15}: {value}\n'
+        if pkg.annotations:
+            out.append(FMT_STR.format('Annotations', ''))
+            for key, value in pkg.annotations.items():
+                out.append(f'\t{key:15}: {value}\n')
 
     if args.size:
-        out += FMT_STR.format('Flat size', size_fmt(pkg_data['flatsize']))
+        out.append(FMT_STR.format('Flat size', size_fmt(pkg.flatsize)))
 
     if args.pkg_message:
-        out += FMT_STR.format('Message', '')
-        if pkg_data.get('messages', None):
-            out += parse_messages(pkg_data['messages'])
+        out.append(FMT_STR.format('Message', ''))
+        messages = getattr(pkg, 'messages', None)
+        if messages:
+            out.append(parse_messages(messages))
 
     if args.dependencies:
-        if pkg_data.get('deps', None):
-            out += FMT_STR.format('Depends on', '')
-            for pkg_name, sub_data in pkg_data['deps'].items():
-                out += f'\t{pkg_name}-{sub_data["version"]}\n'
+        if pkg.deps:
+            out.append(FMT_STR.format('Depends on', ''))
+            for pkg_name, sub_data in pkg.deps.items():
+                out.append(f'\t{pkg_name}-{sub_data["version"]}\n')
 
-    if args.required_by:
-        raise NotImplementedError(
-            'Unable to pull packages requiring this package.')
+    if args.required_by or args.required_by_recursive:
+        conn = pkgdb.connect(config.get_catalogue_dir(appdirs))
+        required_by = pkgdb.get_required_by(conn, pkg.name,
+                                            args.required_by_recursive)
+        if required_by:
+            out.append(FMT_STR.format('Required by', ''))
+            for pkg_name, version in required_by:
+                out.append(f'\t{pkg_name}-{version}\n')
 
-    print(out.strip())
+    print(''.join(out).strip())
 
 
 def parse_messages(messages: Union[list[dict[str, Any]], str]) -> str:
@@ -107,7 +234,7 @@ def parse_messages(messages: Union[list[dict[str, Any]], str]) -> str:
     return out
 
 
-def print_full(pkg_data: dict[str, Any]):
+def print_full(pkg: Package):
     # Order of output:
     # Package name+version (name-version)
     # Name:
@@ -133,64 +260,66 @@ def print_full(pkg_data: dict[str, Any]):
     # Options cut if no data is found.
 
     # Begine parsing through package data.
-    out = ''
+    out: list[str] = []
     FMT_STR = '{:15}: {}\n'
     # Yeah, I have no idea what BSD actually refers to this as.
-    fully_qualified_name: str = f'{pkg_data["name"]}-{pkg_data["version"]}'
+    fully_qualified_name: str = f'{pkg.name}-{pkg.version}'
 
-    out += fully_qualified_name + '\n'
-    out += FMT_STR.format('Name', pkg_data['name'])
-    out += FMT_STR.format('Version', pkg_data['version'])
-    out += FMT_STR.format('Origin', pkg_data['origin'])
-    out += FMT_STR.format('Architecture', pkg_data['abi'])
-    out += FMT_STR.format('Prefix', pkg_data['prefix'])
-    out += FMT_STR.format('Categories',
-                          ', '.join([str(c) for c in pkg_data['categories']]))
+    out.append(fully_qualified_name + '\n')
+    out.append(FMT_STR.format('Name', pkg.name))
+    out.append(FMT_STR.format('Version', pkg.version))
+    out.append(FMT_STR.format('Origin', pkg.origin))
+    out.append(FMT_STR.format('Architecture', pkg.abi))
+    out.append(FMT_STR.format('Prefix', pkg.prefix))
+    out.append(FMT_STR.format('Categories',
+                              ', '.join([str(c) for c in pkg.categories])))
 
     # Special license logic. A package can be single or multi licensed,
     # so to avoid an unnecessary loop we first check the license type.
-    if pkg_data['licenselogic'] == 'single':
-        out += FMT_STR.format('Licenses', pkg_data['licenses'][0])
+    licenses: list[str] = getattr(pkg, 'licenses', [])
+    if getattr(pkg, 'licenselogic', None) == 'single' and licenses:
+        out.append(FMT_STR.format('Licenses', licenses[0]))
     else:
-        out += FMT_STR.format('Licenses',
-                              ', '.join(str(c) for c in pkg_data['licenses']))
+        out.append(FMT_STR.format('Licenses',
+                                  ', '.join(str(c) for c in licenses)))
 
-    out += FMT_STR.format('Maintainer', pkg_data['maintainer'])
-    out += FMT_STR.format('WWW', pkg_data['www'])
-    out += FMT_STR.format('Comment', pkg_data['comment'])
+    out.append(FMT_STR.format('Maintainer', pkg.maintainer))
+    out.append(FMT_STR.format('WWW', pkg.www))
+    out.append(FMT_STR.format('Comment', pkg.comment))
 
     # Options is special, it's optional and displays in a slightly different
     # format, similar to shared libraries required/provided
-    if pkg_data.get('options', None):
-        out += FMT_STR.format('Options', '')
-        for opt, status in pkg_data['options'].items():
-            out += f'\t{opt:16} : {status}\n'
+    options: dict[str, str] = getattr(pkg, 'options', {})
+    if options:
+        out.append(FMT_STR.format('Options', ''))
+        for opt, status in options.items():
+            out.append(f'\t{opt:16} : {status}\n')
 
     # Share libraries required/provided may not be defined, so those also
     # require custom logic
-    if pkg_data.get('shlibs_required', None):
+    if pkg.shlibs_required:
         # Special formatting required for this as well
-        out += 'Shared Libs required:\n'
-        for lib in pkg_data['shlibs_required']:
-            out += f'\t{lib}\n'
-    if pkg_data.get('shlibs_provided', None):
-        out += 'Shared Libs provided:'
-        for lib in pkg_data['shlibs_provided']:
-            out += f'\t{lib}\n'
+        out.append('Shared Libs required:\n')
+        for lib in pkg.shlibs_required:
+            out.append(f'\t{lib}\n')
+    if pkg.shlibs_provided:
+        out.append('Shared Libs provided:')
+        for lib in pkg.shlibs_provided:
+            out.append(f'\t{lib}\n')
 
     # Annotations is weird, as unlike the above two formats,
     # annotations does use a 16-character alignment, but also outputs
     # each annotation on a new line.
-    if pkg_data.get('annotations', None):
+    if pkg.annotations:
         # Blank string as the second argument because it's not actually filled
         # in.
-        out += FMT_STR.format('Annotations', '')
-        for key, val in pkg_data['annotations'].items():
+        out.append(FMT_STR.format('Annotations', ''))
+        for key, val in pkg.annotations.items():
             # This is also a weird format!
-            out += f'\t{key:15}: {val}\n'
+            out.append(f'\t{key:15}: {val}\n')
 
-    out += FMT_STR.format('Flat size', size_fmt(pkg_data['flatsize']))
-    out += FMT_STR.format('Description', '')
-    out += pkg_data['desc']
+    out.append(FMT_STR.format('Flat size', size_fmt(pkg.flatsize)))
+    out.append(FMT_STR.format('Description', ''))
+    out.append(pkg.desc)
 
-    print(out.strip())
+    print(''.join(out).strip())
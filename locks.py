@@ -0,0 +1,162 @@
+'''
+Exclusive locks shared between spkg processes.
+
+A lock is held through a lock file. Where fcntl is available the file is
+locked with flock, which the system releases should its holder die. Elsewhere
+the lock file is created exclusively and removed on release, holding the
+process ID of its holder so one left behind by a killed process can be told
+apart and removed.
+'''
+
+from __future__ import annotations
+from typing import Iterator, Optional
+import contextlib
+import os
+import pathlib
+import time
+try:
+    import fcntl
+except ImportError:
+    # Lock files are created exclusively instead, see acquire.
+    fcntl = None
+if os.name == 'nt':
+    import ctypes
+
+# Seconds between attempts to take a lock held by another process, where
+# there is no fcntl to wait on it.
+POLL_INTERVAL = 0.1
+# Seconds a lock file may be without the process ID of its holder before it
+# is taken to be left behind.
+STALE_AGE = 10
+# Windows API values used to check whether a lock holder is still running.
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+
+
+@contextlib.contextmanager
+def hold(lock_path: pathlib.Path, blocking: bool = True,
+         remove: bool = False) -> Iterator[bool]:
+    '''Hold the exclusive lock of lock_path.
+
+    Waits for any other process holding it, unless not blocking. Yields
+    whether the lock was taken. With remove, the lock file is removed as the
+    lock is released.
+    '''
+    fd = acquire(lock_path, blocking)
+    try:
+        yield fd is not None
+    finally:
+        if fd is not None:
+            release(lock_path, fd, remove)
+
+
+def acquire(lock_path: pathlib.Path, blocking: bool = True) -> Optional[int]:
+    '''Take the lock held through lock_path, see hold.
+
+    Returns the file descriptor holding the lock, or None if it is held by
+    another process and not blocking.
+    '''
+    if fcntl is None:
+        return _create_lock_file(lock_path, blocking)
+
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        # The lock file may have been removed by its holder while waiting,
+        # leaving this lock to nobody else.
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def release(lock_path: pathlib.Path, fd: int, remove: bool = False):
+    if fcntl is None:
+        os.close(fd)
+        lock_path.unlink(missing_ok=True)
+        return
+
+    if remove:
+        # Processes waiting on the removed file notice, see acquire.
+        lock_path.unlink(missing_ok=True)
+    os.close(fd)
+
+
+def _create_lock_file(lock_path: pathlib.Path,
+                      blocking: bool) -> Optional[int]:
+    '''Take a lock by creating lock_path, which must not exist yet.
+
+    The lock file holds the process ID of its holder. One left behind by a
+    process that is no longer running is removed, rather than waited on.
+    '''
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if _remove_stale_lock(lock_path):
+                continue
+            if not blocking:
+                return None
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        os.write(fd, str(os.getpid()).encode())
+        return fd
+
+
+def _remove_stale_lock(lock_path: pathlib.Path) -> bool:
+    '''Remove a lock file whose holder is no longer running.
+
+    Returns whether the lock file is gone.
+    '''
+    try:
+        holder = lock_path.read_text()
+        age = time.time() - lock_path.stat().st_mtime
+    except FileNotFoundError:
+        return True
+
+    if holder.isdigit():
+        if _is_running(int(holder)):
+            return False
+    elif age < STALE_AGE:
+        # Just created, its holder has yet to write its process ID.
+        return False
+
+    try:
+        lock_path.unlink(missing_ok=True)
+    except PermissionError:
+        # Opened by another process again in the meantime.
+        return False
+
+    return True
+
+
+def _is_running(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill would end the process on Windows, ask for its exit code.
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION,
+                                      False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == STILL_ACTIVE
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, as another user.
+        return True
+
+    return True
@@ -1,21 +1,17 @@
 '''
 TODO: Implement repository support.
-TODO: Implement RegEx support for necessary commands.
 TODO: Implement checks against invalid package names.
 TODO: Maybe potentially bring back raw printing of package info?
 '''
 
 import argparse
+import importlib
 import pathlib
+import sys
 from typing import Sequence, Union, Any
 from appdirs import AppDirs
-from util import Config
-
-# Command imports
-import fetch
-import info
-import search
-import update
+from output import FORMATS
+from util import Config, COMMANDS, PKGDB_FILE, read_lines
 
 
 config = Config()
@@ -23,12 +19,10 @@ config = Config()
 # Not including version information here as I don't feel the need to isolate
 # version-specific files.
 dirs = AppDirs(Config.APP_NAME, Config.AUTHOR)
-coms = {
-    'update': update.run,
-    'fetch': fetch.run,
-    'info': info.run,
-    'search': search.run
-}
+
+
+def run_command(command: str, args: argparse.Namespace):
+    importlib.import_module(COMMANDS[command]).run(args, config, dirs)
 
 
 # pylint: disable=protected-access
@@ -56,23 +50,55 @@ def main(args: argparse.Namespace):
         config.architecture = args.arch
     if args.release_type:
         config.release_type = args.release_type
+    if args.timeout:
+        config.timeout = args.timeout
+    if args.retries is not None:
+        config.retries = args.retries
+
+    # Names and patterns on stdin are added to those given as arguments, so
+    # large batches need only one process.
+    if getattr(args, 'stdin', False):
+        args.pkg_name += read_lines(sys.stdin)
+
+    # Hand the command to a running spkg serve instead, if asked to.
+    if args.server is not None:
+        import serve
+        if args.command in serve.CLIENT_COMMANDS:
+            path = pathlib.Path(args.server) if args.server \
+                else serve.get_socket_path(dirs)
+            result = serve.request(path, {
+                'command': 'cli',
+                'args': vars(args),
+                'freebsd_version': args.freebsd_version,
+                'arch': args.arch,
+                'release_type': args.release_type
+            })
+            print(result['stdout'], end='')
+            print(result['stderr'], end='', file=sys.stderr)
+            sys.exit(result['status'])
 
-    if not check_pkgdb() and not args.command == 'update':
+    if not check_pkgdb() and args.command not in ('update', 'serve'):
         resp = input("No package database downloaded. Would you like to run \
 update first? [y/n]> ")
         if resp[0] == 'y':
-            coms['update'](argparse.Namespace(), config, dirs)
+            run_command('update',
+                        argparse.Namespace(force=False, all_abis=False))
 
     # Execute the command we need to be running
-    coms[args.command](args, config, dirs)
+    run_command(args.command, args)
 
 
 def check_pkgdb():
-    fpath = pathlib.Path(dirs.user_cache_dir, 'pkgdb.yaml')
+    fpath = pathlib.Path(config.get_catalogue_dir(dirs), PKGDB_FILE)
     return fpath.exists()
 
 
 if __name__ == "__main__":
+    # Needed for process pools in frozen (PyInstaller) builds.
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+
     parser = argparse.ArgumentParser(Config.APP_NAME,
                                      description='manipulate packages',
                                      allow_abbrev=False)
@@ -85,9 +111,18 @@ if __name__ == "__main__":
                         help="Architecture to download packages for.")
     parser.add_argument('--release-type', action='store', type=str,
                         help="Which release type to download packages from.\
-                            (do not mix release types, if you chose LATEST\
-                                before, choose latest again if using the same\
-                                    version of BSD).")
+                            Every version, architecture and release type has\
+                            its own package database.")
+    parser.add_argument('--timeout', action='store', type=float,
+                        help="Seconds to wait on the repository before giving\
+                            up on a request.")
+    parser.add_argument('--retries', action='store', type=int,
+                        help="Number of times to retry a failed request.")
+    parser.add_argument('--server', action='store', type=str, nargs='?',
+                        const='', metavar='SOCKET',
+                        help="Send info, search and which-lib commands to a\
+                            running spkg serve, listening on SOCKET or on the\
+                            default socket.")
 
     commands = parser.add_subparsers(title='commands', required=True,
                                      dest='command')
@@ -99,6 +134,13 @@ if __name__ == "__main__":
     update_p.add_argument('-r', '--repository', action="store", type=str,
                           help="Download the catalogue for the named repository\
                             only.")
+    update_p.add_argument('-f', '--force', action='store_true',
+                          help="Force a full download of the catalogue, even if\
+                            it has not changed since the last update.")
+    update_p.add_argument('--all-abis', action='store_true',
+                          help="Update the catalogue of every version,\
+                            architecture and release type downloaded before,\
+                            along with the selected one, at the same time.")
 
     fetch_p = commands.add_parser('fetch',
                                   help="Fetch packages from remote repository.",
@@ -110,6 +152,29 @@ if __name__ == "__main__":
                          help="Place files in the sub-directory specified.")
     fetch_p.add_argument('-d', '--dependencies', action='store_true',
                          help="Fetch the package and its dependencies.")
+    fetch_p.add_argument('-j', '--jobs', action='store', type=int, default=4,
+                         help="Number of packages to download at the same\
+                             time.")
+    fetch_p.add_argument('--chunk-size', action='store', type=int,
+                         help="Size, in KiB, of the blocks packages are\
+                             downloaded in.")
+    fetch_p.add_argument('--limit-rate', action='store', type=int,
+                         help="Limit the combined download speed, in KiB per\
+                             second.")
+    fetch_p.add_argument('--host-jobs', action='store', type=int,
+                         help="Maximum number of downloads from the same host\
+                             at the same time.")
+    fetch_p.add_argument('--verify-existing', action='store_true',
+                         help="Check the checksum of packages that have already\
+                             been downloaded, fetching them again if they do\
+                             not match.")
+    fetch_p.add_argument('--store-size', action='store', type=int,
+                         help="Size, in MiB, the shared store of downloaded\
+                             packages is trimmed to after fetching.")
+    fetch_p.add_argument('--format', action='store', choices=FORMATS,
+                         default='text',
+                         help="List the packages that would be fetched in this\
+                             format, instead of fetching them.")
     fetch_p.add_argument('pkg_name', action='store', nargs='*',
                          help="Package(s) to fetch.")
 
@@ -132,13 +197,19 @@ if __name__ == "__main__":
                         help="Display the list of packages on which pkg_name\
                                depends.")
     info_p.add_argument('-r', '--required-by', action=InfoAction,
-                        help="Display the list of packages on which pkg_name\
-                            depends.")
+                        help="Display the list of packages which require\
+                            pkg_name.")
+    info_p.add_argument('--required-by-recursive', action=InfoAction,
+                        help="Display the list of packages which require\
+                            pkg_name, directly or indirectly.")
     info_p.add_argument('-b', '--provided-shlibs', action=InfoAction,
                         help="Display all shared libraries provided by\
                             pkg_name")
     info_p.add_argument('-B', '--required-shlibs', action=InfoAction,
                         help="Display all shared libraries used by pkg_name.")
+    info_p.add_argument('--resolve-shlibs', action=InfoAction,
+                        help="Display all shared libraries used by pkg_name,\
+                            along with the packages providing them.")
     info_p.add_argument('-s', '--size', action=InfoAction,
                         help="Display the total size of files installed by\
                             pkg_name.")
@@ -147,7 +218,14 @@ if __name__ == "__main__":
     info_p.add_argument('-p', '--prefix', action=InfoAction,
                         help="Display the installation prefix for each package\
                             matching pkg_name.")
-    info_p.add_argument('pkg_name', action='store', nargs='+',
+    info_p.add_argument('--format', action='store', choices=FORMATS,
+                        default='text',
+                        help="Output format, one record per package.")
+    info_p.add_argument('--stdin', action='store_true',
+                        help="Also read package names from stdin, one per\
+                            line. Packages are displayed in the order of the\
+                            package database.")
+    info_p.add_argument('pkg_name', action='store', nargs='*',
                         help="Package(s) to display information for.")
 
     search_p = commands.add_parser('search',
@@ -164,9 +242,14 @@ if __name__ == "__main__":
     search_p.add_argument('-d', '--depends-on', action='store_true',
                           help="Display the list of packages depended on by each\
                           matched package.")
-    search_p.add_argument('-e', '--exact', action='store_true',
-                          help="pkg_name should be an exact match against the\
-                              search field.")
+    search_match = search_p.add_mutually_exclusive_group()
+    search_match.add_argument('-e', '--exact', action='store_true',
+                              help="pkg_name should be an exact match against\
+                                  the search field.")
+    search_match.add_argument('-x', '--regex', action='store_true',
+                              help="Treat pkg_name as a regular expression.")
+    search_match.add_argument('-g', '--glob', action='store_true',
+                              help="Treat pkg_name as a shell glob pattern.")
     search_p.add_argument('-o', '--origins', action='store_true',
                           help="List packages by origin for each package\
                               matching pkg_name.")
@@ -176,8 +259,32 @@ if __name__ == "__main__":
     search_p.add_argument('-s', '--size', action='store_true',
                           help="Display the installed size of matched packages.\
                               ")
-    search_p.add_argument('pkg_name', action='store', nargs='+',
-                          help="Package name or pattern to search for. RegEx not\
-                              supported.")
+    search_p.add_argument('-j', '--jobs', action='store', type=int,
+                          help="Scan the raw package database using this many\
+                              processes instead of using the search index.")
+    search_p.add_argument('--format', action='store', choices=FORMATS,
+                          default='text',
+                          help="Output format, one record per package.")
+    search_p.add_argument('--stdin', action='store_true',
+                          help="Also read patterns from stdin, one per line.")
+    search_p.add_argument('pkg_name', action='store', nargs='*',
+                          help="Package name or pattern to search for.")
+
+    which_lib_p = commands.add_parser('which-lib',
+                                      help="Find the packages providing a\
+                                          shared library.",
+                                      description="Display the packages\
+                                          providing shared libraries.")
+    which_lib_p.add_argument('soname', action='store', nargs='+',
+                             help="Shared library name(s), such as\
+                                 libfoo.so.3.")
+
+    serve_p = commands.add_parser('serve',
+                                  help="Answer queries from a daemon keeping\
+                                      the package database loaded.",
+                                  description="Serve package database queries\
+                                      over a Unix socket.")
+    serve_p.add_argument('--socket', action='store', type=str,
+                         help="Path of the socket to listen on.")
 
     main(parser.parse_args())
@@ -0,0 +1,86 @@
+'''
+Machine readable output of package records.
+
+Records are written out one at a time, as soon as a command produces them, so
+output can be piped into other tools without spkg holding on to it. Records
+read straight from pkgdb.yaml can be copied to the output as they are, never
+being decoded and encoded again.
+'''
+
+from __future__ import annotations
+from typing import Any, Optional, TextIO
+import json
+import sys
+
+# Output formats accepted by --format, text being each command's own output.
+FORMATS = ('text', 'json', 'ndjson', 'tsv')
+
+
+class RecordWriter():
+    '''Write records as a JSON array, JSON lines or tab separated values.
+
+    Only the given columns are written as TSV, which starts with a header
+    line. TSV values have backslashes, tabs and newlines escaped, and fields
+    holding lists or mappings are written as JSON. Use as a context manager,
+    the output is only complete once the writer is closed.
+    '''
+
+    def __init__(self, fmt: str, columns: list[str],
+                 out: Optional[TextIO] = None):
+        if fmt not in FORMATS[1:]:
+            raise Exception(f'Unsupported output format: {fmt}')
+
+        self.fmt = fmt
+        self.columns = columns
+        self.out = out if out is not None else sys.stdout
+        self._count: int = 0
+
+    def __enter__(self) -> RecordWriter:
+        if self.fmt == 'json':
+            self.out.write('[')
+        elif self.fmt == 'tsv':
+            self.out.write('\t'.join(self.columns) + '\n')
+
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        if self.fmt == 'json':
+            self.out.write('\n]\n' if self._count else ']\n')
+        self.out.flush()
+
+    def write(self, record: dict[str, Any]):
+        if self.fmt == 'tsv':
+            self.out.write('\t'.join(tsv_value(record.get(column))
+                                     for column in self.columns) + '\n')
+        else:
+            self._write_json(json.dumps(record))
+
+    def write_raw(self, line: bytes):
+        '''Write a record given as a line of pkgdb.yaml.
+
+        The line is copied as it is for JSON output, TSV output still has to
+        decode it.
+        '''
+        if self.fmt == 'tsv':
+            self.write(json.loads(line))
+            return
+
+        self._write_json(line.rstrip(b'\n').decode())
+
+    def _write_json(self, text: str):
+        if self.fmt == 'json':
+            text = ('\n' if not self._count else ',\n') + text
+        else:
+            text += '\n'
+        self.out.write(text)
+        self._count += 1
+
+
+def tsv_value(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
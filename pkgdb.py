@@ -0,0 +1,553 @@
+'''
+Local SQLite catalogue generated from pkgdb.yaml.
+
+pkgdb.yaml stays the raw copy of the repository's packagesite.yaml, one JSON
+record per line. The SQLite database holds the columns commands query on, the
+byte offset of every record in pkgdb.yaml, and the list-valued fields split out
+into their own tables, so most commands never have to decode JSON at all.
+
+Every ABI and release type has a catalogue of its own, each kept in a separate
+directory (see Config.get_catalogue_dir).
+'''
+
+from __future__ import annotations
+from typing import Any, BinaryIO, Iterable, Iterator, Optional
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import locks
+
+PKGDB_FILE = 'pkgdb.yaml'
+PKGDB_SQLITE_FILE = 'pkgdb.sqlite'
+# Held while the catalogue is built, see build.
+PKGDB_LOCK_FILE = 'pkgdb.lock'
+
+# Bump whenever _SCHEMA changes, existing databases are then regenerated from
+# pkgdb.yaml the next time they are opened.
+SCHEMA_VERSION = 6
+
+_SCHEMA = '''
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE packages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    origin TEXT NOT NULL,
+    version TEXT NOT NULL,
+    pkgsize INTEGER NOT NULL,
+    flatsize INTEGER NOT NULL,
+    comment TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    description TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    line_offset INTEGER NOT NULL,
+    line_length INTEGER NOT NULL,
+    digest BLOB NOT NULL
+);
+CREATE INDEX packages_origin ON packages (origin);
+CREATE INDEX packages_version ON packages (version);
+CREATE INDEX packages_pkgsize ON packages (pkgsize);
+CREATE INDEX packages_flatsize ON packages (flatsize);
+CREATE INDEX packages_comment ON packages (comment);
+CREATE INDEX packages_prefix ON packages (prefix);
+CREATE TABLE deps (
+    package TEXT NOT NULL,
+    name TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    version TEXT NOT NULL
+);
+CREATE INDEX deps_package ON deps (package);
+CREATE INDEX deps_name ON deps (name);
+CREATE TABLE shlibs (
+    package TEXT NOT NULL,
+    shlib TEXT NOT NULL,
+    provided INTEGER NOT NULL
+);
+CREATE INDEX shlibs_package ON shlibs (package);
+CREATE INDEX shlibs_shlib ON shlibs (shlib, provided);
+CREATE TABLE categories (
+    package TEXT NOT NULL,
+    category TEXT NOT NULL
+);
+CREATE INDEX categories_package ON categories (package);
+CREATE TABLE annotations (
+    package TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX annotations_package ON annotations (package);
+'''
+
+# Trigram index for substring searches of the name, comment and description.
+# It needs SQLite 3.34 or newer, without it searches fall back to scanning the
+# packages table. The triggers keep it in step with the packages table.
+_SEARCH_INDEX_SCHEMA = '''
+CREATE VIRTUAL TABLE search_index USING fts5 (
+    name, comment, description,
+    content='packages', content_rowid='id',
+    tokenize='trigram case_sensitive 1'
+);
+CREATE TRIGGER packages_search_insert AFTER INSERT ON packages BEGIN
+    INSERT INTO search_index (rowid, name, comment, description)
+        VALUES (new.id, new.name, new.comment, new.description);
+END;
+CREATE TRIGGER packages_search_delete AFTER DELETE ON packages BEGIN
+    INSERT INTO search_index (search_index, rowid, name, comment, description)
+        VALUES ('delete', old.id, old.name, old.comment, old.description);
+END;
+'''
+
+# Record fields stored as columns of the packages table.
+COLUMNS: dict[str, str] = {
+    'name': 'name',
+    'origin': 'origin',
+    'version': 'version',
+    'pkgsize': 'pkgsize',
+    'flatsize': 'flatsize',
+    'comment': 'comment',
+    'prefix': 'prefix',
+    'desc': 'description',
+    'sum': 'checksum'
+}
+# Record fields split out into their own tables.
+TABLE_FIELDS = ('deps', 'shlibs_required', 'shlibs_provided', 'categories',
+                'annotations')
+
+_CONNECTIONS: dict[str, sqlite3.Connection] = {}
+
+
+def connect(db_dir: pathlib.Path) -> sqlite3.Connection:
+    '''Return a connection to the catalogue, generating it if required.
+
+    The connection is kept open for the life of the process, and may be used
+    from any thread as long as only one uses it at a time. If the database
+    is missing, was generated with an older schema or does not describe the
+    pkgdb.yaml on disk, it is regenerated from pkgdb.yaml first.
+    '''
+    db_path = pathlib.Path(db_dir, PKGDB_SQLITE_FILE)
+    key = str(db_path)
+    if key in _CONNECTIONS:
+        return _CONNECTIONS[key]
+
+    if not is_current(db_dir):
+        # Another process may be in the middle of building the catalogue,
+        # which is only known to be out of date once it has finished.
+        with locks.hold(pathlib.Path(db_dir, PKGDB_LOCK_FILE)):
+            if not is_current(db_dir):
+                _build(db_dir)
+
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    _CONNECTIONS[key] = conn
+
+    return conn
+
+
+def close(db_dir: Optional[pathlib.Path] = None):
+    '''Close the connection to one catalogue, or to every catalogue.'''
+    if db_dir is not None:
+        conn = _CONNECTIONS.pop(str(pathlib.Path(db_dir, PKGDB_SQLITE_FILE)),
+                                None)
+        if conn is not None:
+            conn.close()
+        return
+
+    for conn in _CONNECTIONS.values():
+        conn.close()
+    _CONNECTIONS.clear()
+
+
+def is_current(db_dir: pathlib.Path) -> bool:
+    '''Check that the catalogue exists and matches pkgdb.yaml.'''
+    yaml_path = pathlib.Path(db_dir, PKGDB_FILE)
+    if not yaml_path.exists():
+        return False
+
+    meta = read_meta(db_dir)
+
+    return meta.get('schema_version') == str(SCHEMA_VERSION) and \
+        meta.get('pkgdb_size') == str(yaml_path.stat().st_size)
+
+
+def read_meta(db_dir: pathlib.Path) -> dict[str, str]:
+    '''Read the meta values of a catalogue without keeping it open.
+
+    Returns an empty dict if there is no usable catalogue.
+    '''
+    db_path = pathlib.Path(db_dir, PKGDB_SQLITE_FILE)
+    if not db_path.exists():
+        return {}
+
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            return dict(conn.execute('SELECT key, value FROM meta'))
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return {}
+
+
+def build(db_dir: pathlib.Path, stream: Optional[Iterable[bytes]] = None,
+          meta: Optional[dict[str, str]] = None) -> dict[str, int]:
+    '''Generate or update the SQLite catalogue.
+
+    With no stream, the catalogue is regenerated from the existing pkgdb.yaml.
+    Otherwise stream yields the lines of a packagesite.yaml, which are written
+    out as the new pkgdb.yaml and loaded into the database in a single pass.
+    If a current catalogue already exists it is updated in place, only
+    records that were added, changed or removed are touched. Any meta values
+    given are stored alongside the catalogue.
+
+    Only one process builds a catalogue at a time, others wait for the lock
+    in PKGDB_LOCK_FILE. Returns the number of packages added, changed and
+    removed.
+    '''
+    with locks.hold(pathlib.Path(db_dir, PKGDB_LOCK_FILE)):
+        return _build(db_dir, stream, meta)
+
+
+def _build(db_dir: pathlib.Path, stream: Optional[Iterable[bytes]] = None,
+           meta: Optional[dict[str, str]] = None) -> dict[str, int]:
+    '''Generate or update the catalogue, see build. Needs the lock held.'''
+    yaml_path = pathlib.Path(db_dir, PKGDB_FILE)
+    db_path = pathlib.Path(db_dir, PKGDB_SQLITE_FILE)
+
+    # Left behind by builds that did not finish.
+    for path in pathlib.Path(db_dir).glob('pkgdb.*.tmp*'):
+        path.unlink(missing_ok=True)
+
+    incremental = stream is not None and is_current(db_dir)
+    close(db_dir)
+
+    if incremental:
+        conn = sqlite3.connect(db_path)
+    else:
+        tmp_db_path = _make_temp(db_dir, PKGDB_SQLITE_FILE)
+        conn = sqlite3.connect(tmp_db_path)
+        conn.executescript(_SCHEMA)
+        try:
+            conn.executescript(_SEARCH_INDEX_SCHEMA)
+            set_meta(conn, 'search_index', '1')
+        except sqlite3.OperationalError:
+            set_meta(conn, 'search_index', '0')
+
+    try:
+        if stream is None:
+            with open(yaml_path, 'rb') as f:
+                changes = load_records(conn, iter_lines(f))
+        else:
+            tmp_yaml_path = _make_temp(db_dir, PKGDB_FILE)
+            with open(tmp_yaml_path, 'wb') as f:
+                changes = load_records(conn, iter_lines(_tee(stream, f)))
+
+        set_meta(conn, 'schema_version', str(SCHEMA_VERSION))
+        new_yaml_path = tmp_yaml_path if stream is not None else yaml_path
+        set_meta(conn, 'pkgdb_size', str(new_yaml_path.stat().st_size))
+        for key, value in (meta or {}).items():
+            set_meta(conn, key, value)
+
+        # The database only matches the new pkgdb.yaml, so it is swapped in
+        # before the transaction is committed. connect() spots the mismatch
+        # through pkgdb_size should anything fail in between.
+        if stream is not None:
+            os.replace(tmp_yaml_path, yaml_path)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if not incremental:
+        os.replace(tmp_db_path, db_path)
+
+    return changes
+
+
+def _make_temp(db_dir: pathlib.Path, name: str) -> pathlib.Path:
+    '''Create an empty file of a unique name, to be moved to name once done.'''
+    fd, path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=db_dir)
+    os.close(fd)
+
+    return pathlib.Path(path)
+
+
+def iter_lines(lines: Iterable[bytes]) -> Iterator[tuple[int, bytes]]:
+    '''Pair every line of a package database with its byte offset.'''
+    offset: int = 0
+    for line in lines:
+        yield offset, line
+        offset += len(line)
+
+
+def load_records(conn: sqlite3.Connection,
+                 lines: Iterable[tuple[int, bytes]]) -> dict[str, int]:
+    '''Bring the catalogue in line with the given pkgdb.yaml lines.
+
+    Records are matched against the catalogue by a digest of their raw line,
+    so unchanged records only have their location updated and are never
+    decoded. Packages missing from lines are removed.
+    '''
+    known: dict[bytes, str] = dict(
+        conn.execute('SELECT digest, name FROM packages'))
+    remaining: set[str] = set(known.values())
+    moved: list[tuple[int, int, str]] = []
+    changes: dict[str, int] = {'added': 0, 'changed': 0, 'removed': 0}
+
+    for offset, line in lines:
+        digest = _digest(line)
+        if digest in known:
+            name = known[digest]
+            moved.append((offset, len(line), name))
+            remaining.discard(name)
+            continue
+
+        data: dict[str, Any] = json.loads(line)
+        if data['name'] in remaining:
+            delete_record(conn, data['name'])
+            remaining.discard(data['name'])
+            changes['changed'] += 1
+        else:
+            changes['added'] += 1
+        insert_record(conn, data, offset, len(line), digest)
+
+    conn.executemany('UPDATE packages SET line_offset = ?, line_length = ?\
+ WHERE name = ?', moved)
+
+    for name in remaining:
+        delete_record(conn, name)
+    changes['removed'] = len(remaining)
+
+    return changes
+
+
+def insert_record(conn: sqlite3.Connection, data: dict[str, Any],
+                  offset: int, length: int, digest: bytes):
+    name: str = data['name']
+    conn.execute('INSERT INTO packages (name, origin, version, pkgsize,\
+ flatsize, comment, prefix, description, checksum, line_offset, line_length,\
+ digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (name, data['origin'], data['version'], data['pkgsize'],
+                  data['flatsize'], data['comment'], data['prefix'],
+                  data.get('desc', ''), data.get('sum', ''), offset, length,
+                  digest))
+
+    conn.executemany('INSERT INTO deps VALUES (?, ?, ?, ?)',
+                     [(name, dep, sub['origin'], sub['version'])
+                      for dep, sub in data.get('deps', {}).items()])
+    conn.executemany('INSERT INTO shlibs VALUES (?, ?, 0)',
+                     [(name, lib) for lib in data.get('shlibs_required', [])])
+    conn.executemany('INSERT INTO shlibs VALUES (?, ?, 1)',
+                     [(name, lib) for lib in data.get('shlibs_provided', [])])
+    conn.executemany('INSERT INTO categories VALUES (?, ?)',
+                     [(name, c) for c in data.get('categories', [])])
+    conn.executemany('INSERT INTO annotations VALUES (?, ?, ?)',
+                     [(name, str(tag), str(value)) for tag, value in
+                      data.get('annotations', {}).items()])
+
+
+def delete_record(conn: sqlite3.Connection, name: str):
+    for table in ('deps', 'shlibs', 'categories', 'annotations'):
+        conn.execute(f'DELETE FROM {table} WHERE package = ?', (name,))
+    conn.execute('DELETE FROM packages WHERE name = ?', (name,))
+
+
+def get_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                       (key,)).fetchone()
+
+    return row[0] if row else None
+
+
+def set_meta(conn: sqlite3.Connection, key: str, value: str):
+    conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+
+def get_location(conn: sqlite3.Connection,
+                 pkg_name: str) -> Optional[tuple[int, int]]:
+    '''Return the offset and length of a package's record in pkgdb.yaml.'''
+    row = conn.execute('SELECT line_offset, line_length FROM packages\
+ WHERE name = ?', (pkg_name,)).fetchone()
+
+    return (row[0], row[1]) if row else None
+
+
+def has_search_index(conn: sqlite3.Connection) -> bool:
+    return get_meta(conn, 'search_index') == '1'
+
+
+def read_fields(db_dir: pathlib.Path, fields: Optional[list[str]],
+                pkg_names: Optional[Iterable[str]] = None,
+                by_offset: bool = False) -> Iterator[dict[str, Any]]:
+    '''Read only the given fields of packages.
+
+    Fields kept in the catalogue are read straight from it, a package's JSON
+    record in pkgdb.yaml is only decoded when some other field is asked for.
+    With fields as None the whole record is returned.
+
+    Packages are returned in the order of pkg_names, leaving out unknown
+    names. Without pkg_names every package is returned, in alphabetical order.
+    With by_offset, packages are returned in the order of their records in
+    pkgdb.yaml instead, so the file is read from front to back.
+    '''
+    conn = connect(db_dir)
+    if fields is None:
+        fields = []
+        decoded = whole = True
+    else:
+        decoded = any(field not in COLUMNS and field not in TABLE_FIELDS
+                      for field in fields)
+        whole = False
+    column_fields = [field for field in fields if field in COLUMNS]
+    table_fields = [field for field in fields if field in TABLE_FIELDS]
+
+    select = ', '.join(['name', 'line_offset', 'line_length'] +
+                       [COLUMNS[field] for field in column_fields])
+    order = 'line_offset' if by_offset else 'name'
+    if pkg_names is None:
+        rows = conn.execute(f'SELECT {select} FROM packages ORDER BY {order}')
+    else:
+        rows = _select_by_name(conn, select, list(pkg_names))
+        if by_offset:
+            rows.sort(key=lambda row: row[1])
+
+    with open(pathlib.Path(db_dir, PKGDB_FILE), 'rb') as f:
+        for row in rows:
+            record: dict[str, Any] = {}
+            if decoded:
+                f.seek(row[1])
+                data: dict[str, Any] = json.loads(f.read(row[2]))
+                record = data if whole else {field: data[field]
+                                             for field in fields
+                                             if field in data}
+            record.update(zip(column_fields, row[3:]))
+            for field in table_fields:
+                record[field] = read_table_field(conn, row[0], field)
+            yield record
+
+
+def read_raw(db_dir: pathlib.Path, pkg_names: Iterable[str],
+             by_offset: bool = False) -> Iterator[tuple[str, bytes]]:
+    '''Read the records of packages as their raw lines of pkgdb.yaml.
+
+    Each line is returned with the name of its package, in the same order as
+    read_fields would return them.
+    '''
+    rows = _select_by_name(connect(db_dir), 'name, line_offset, line_length',
+                           list(pkg_names))
+    if by_offset:
+        rows.sort(key=lambda row: row[1])
+
+    with open(pathlib.Path(db_dir, PKGDB_FILE), 'rb') as f:
+        for name, offset, length in rows:
+            f.seek(offset)
+            yield name, f.read(length)
+
+
+def read_table_field(conn: sqlite3.Connection, pkg_name: str,
+                     field: str) -> Any:
+    '''Rebuild a record field that is stored in its own table.'''
+    if field == 'deps':
+        rows = conn.execute('SELECT name, origin, version FROM deps\
+ WHERE package = ? ORDER BY rowid', (pkg_name,))
+        return {name: {'origin': origin, 'version': version}
+                for name, origin, version in rows}
+    if field in ('shlibs_required', 'shlibs_provided'):
+        rows = conn.execute('SELECT shlib FROM shlibs\
+ WHERE package = ? AND provided = ? ORDER BY rowid',
+                            (pkg_name, int(field == 'shlibs_provided')))
+        return [row[0] for row in rows]
+    if field == 'categories':
+        rows = conn.execute('SELECT category FROM categories\
+ WHERE package = ? ORDER BY rowid', (pkg_name,))
+        return [row[0] for row in rows]
+    if field == 'annotations':
+        rows = conn.execute('SELECT tag, value FROM annotations\
+ WHERE package = ? ORDER BY rowid', (pkg_name,))
+        return dict(rows)
+
+    raise KeyError(field)
+
+
+def select_in(conn: sqlite3.Connection, query: str,
+              values: list[Any]) -> Iterator[tuple[Any, ...]]:
+    '''Run a query matching a list of values, returning the rows of each.
+
+    The query's IN list is written as {values}, which is filled with the
+    placeholders of a batch of values. The query is run once per batch, as
+    older SQLite builds allow at most 999 parameters per statement.
+    '''
+    for i in range(0, len(values), 500):
+        batch = values[i:i + 500]
+        yield from conn.execute(
+            query.format(values=', '.join('?' * len(batch))), batch)
+
+
+def _select_by_name(conn: sqlite3.Connection, select: str,
+                    pkg_names: list[str]) -> list[tuple[Any, ...]]:
+    found: dict[str, tuple[Any, ...]] = {
+        row[0]: row for row in select_in(conn, f'SELECT {select} FROM packages\
+ WHERE name IN ({{values}})', pkg_names)}
+
+    return [found[name] for name in dict.fromkeys(pkg_names)
+            if name in found]
+
+
+def get_required_by(conn: sqlite3.Connection, pkg_name: str,
+                    recursive: bool = False) -> list[tuple[str, str]]:
+    '''Return the name and version of every package depending on pkg_name.
+
+    With recursive, packages that depend on pkg_name indirectly are included.
+    pkg_name itself is left out even when its dependencies form a cycle.
+    '''
+    if recursive:
+        rows = conn.execute('''
+WITH RECURSIVE required_by (name) AS (
+    SELECT package FROM deps WHERE name = ?
+    UNION
+    SELECT deps.package FROM deps
+        JOIN required_by ON deps.name = required_by.name
+)
+SELECT packages.name, packages.version FROM packages
+    JOIN required_by ON packages.name = required_by.name
+    WHERE packages.name != ?
+    ORDER BY packages.name''', (pkg_name, pkg_name))
+    else:
+        rows = conn.execute('''
+SELECT packages.name, packages.version FROM packages
+    JOIN deps ON packages.name = deps.package
+    WHERE deps.name = ?
+    ORDER BY packages.name''', (pkg_name,))
+
+    return list(rows)
+
+
+def get_providers(conn: sqlite3.Connection, shlibs: Iterable[str]
+                  ) -> dict[str, list[tuple[str, str]]]:
+    '''Return the name and version of the packages providing each shlib.
+
+    Every shlib is a key of the result, those that no package provides map to
+    an empty list.
+    '''
+    providers: dict[str, list[tuple[str, str]]] = {
+        shlib: [] for shlib in shlibs}
+    rows = select_in(conn, 'SELECT shlibs.shlib, packages.name,\
+ packages.version FROM shlibs JOIN packages ON packages.name = shlibs.package\
+ WHERE shlibs.shlib IN ({values}) AND shlibs.provided = 1\
+ ORDER BY packages.name', list(providers))
+    for shlib, name, version in rows:
+        providers[shlib].append((name, version))
+
+    return providers
+
+
+def _tee(lines: Iterable[bytes], out: BinaryIO) -> Iterator[bytes]:
+    for line in lines:
+        out.write(line)
+        yield line
+
+
+def _digest(line: bytes) -> bytes:
+    return hashlib.blake2b(line, digest_size=16).digest()
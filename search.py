@@ -1,61 +1,258 @@
 from __future__ import annotations
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator
+from argparse import Namespace
+import fnmatch
+import heapq
 import json
+import mmap
 import pathlib
-from argparse import Namespace
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from appdirs import AppDirs
-from util import size_fmt, Config
+import pkgdb
+from pkgdb import PKGDB_FILE
+from output import RecordWriter
+from util import size_fmt, Config, Package, iter_packages
 
 
-def run(args: Namespace, _config: Config, appdirs: AppDirs):
+def run(args: Namespace, config: Config, appdirs: AppDirs):
+    # Lines from stdin have already been added, which may leave nothing.
     patterns: list[str] = args.pkg_name
+    if not patterns:
+        raise Exception('Must include at least 1 pattern to search for.')
+
+    if args.jobs:
+        names: list[str] = scan_search(patterns, args.comment,
+                                       args.description, args.exact,
+                                       config.get_catalogue_dir(appdirs),
+                                       args.regex, args.glob, args.jobs)
+    else:
+        names = begin_search(patterns, args.comment, args.description,
+                             args.exact, config.get_catalogue_dir(appdirs),
+                             args.regex, args.glob)
 
-    hits: list[dict[str, Any]] = begin_search(patterns, args.comment,
-                                              args.description,
-                                              args.exact, appdirs)
-    hits = sorted(hits, key=lambda data: data['name'])
+    # Only read the fields that will be displayed.
+    fields: list[str] = ['name', 'version', 'origin', 'comment']
+    if args.prefix:
+        fields.append('prefix')
+    if args.size:
+        fields.append('flatsize')
+    if args.depends_on:
+        fields.append('deps')
+    hits: Iterator[Package] = iter_packages(names, fields, config, appdirs)
+
+    if args.format != 'text':
+        with RecordWriter(args.format, fields) as writer:
+            for pkg in hits:
+                writer.write({field: getattr(pkg, field) for field in fields})
+        return
 
     display_results(hits, args.depends_on, args.origins, args.prefix, args.size)
 
 
 def begin_search(patterns: list[str], search_comments: bool,
                  search_descriptions: bool,
-                 exact: bool, appdirs: AppDirs) -> list[dict[str, Any]]:
-    hits: list[dict[str, Any]] = []
-    with open(pathlib.Path(appdirs.user_cache_dir, 'pkgdb.yaml'), 'r') as f:
-        for line in f.readlines():
+                 exact: bool, db_dir: pathlib.Path, regex: bool = False,
+                 glob: bool = False) -> list[str]:
+    '''Return the names of all packages matching any of the patterns.
+
+    Names are returned in alphabetical order.
+    '''
+    fields: list[str] = ['name']
+    if search_comments:
+        fields.append('comment')
+    if search_descriptions:
+        fields.append('description')
+
+    conn = pkgdb.connect(db_dir)
+
+    if regex or glob:
+        return match_search(conn, make_matcher(patterns, exact, regex, glob),
+                            fields)
+
+    names: set[str] = set()
+    if exact:
+        # Name and comment are indexed, so these are straight lookups.
+        for field in fields:
+            names.update(row[0] for row in pkgdb.select_in(
+                conn, f'SELECT name FROM packages\
+ WHERE {field} IN ({{values}})', patterns))
+
+        return sorted(names)
+
+    indexed: bool = pkgdb.has_search_index(conn)
+
+    queries: list[tuple[str, list[str]]] = []
+    for pattern in patterns:
+        if indexed and len(pattern) >= 3:
+            # Trigrams can only find patterns of at least three characters.
+            queries.append(('SELECT rowid FROM search_index\
+ WHERE search_index MATCH ?', [make_phrase_query(fields, pattern)]))
+        else:
+            queries.append(('SELECT id FROM packages WHERE ' + ' OR '.join(
+                f'instr({field}, ?) > 0' for field in fields),
+                [pattern] * len(fields)))
+
+    # SQLite limits a compound select to 500 queries, so large batches of
+    # patterns are searched for a hundred at a time.
+    for i in range(0, len(queries), 100):
+        batch = queries[i:i + 100]
+        union = ' UNION '.join(query for query, _ in batch)
+        rows = conn.execute(f'SELECT name FROM packages WHERE id IN ({union})',
+                            [param for _, params in batch for param in params])
+        names.update(row[0] for row in rows)
+
+    return sorted(names)
+
+
+def compile_patterns(patterns: list[str], glob: bool) -> re.Pattern[str]:
+    '''Combine every pattern into a single regular expression.
+
+    Regular expressions match anywhere in a field, globs must match the whole
+    field.
+    '''
+    if glob:
+        patterns = [fnmatch.translate(pattern) for pattern in patterns]
+
+    try:
+        return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+    except re.error as e:
+        raise Exception(f'Invalid search pattern: {e}') from e
+
+
+def make_matcher(patterns: list[str], exact: bool, regex: bool,
+                 glob: bool) -> Callable[[str], bool]:
+    '''Return a function checking a field against every pattern at once.
+
+    Without any patterns nothing matches.
+    '''
+    if not patterns:
+        return lambda text: False
+
+    if regex or glob:
+        pattern = compile_patterns(patterns, glob)
+        match = pattern.match if glob else pattern.search
+        return lambda text: match(text) is not None
+
+    if exact:
+        wanted = set(patterns)
+        return lambda text: text in wanted
+
+    return lambda text: any(pattern in text for pattern in patterns)
+
+
+def match_search(conn: sqlite3.Connection, matcher: Callable[[str], bool],
+                 fields: list[str]) -> list[str]:
+    '''Return the names of packages with a field accepted by matcher.
+
+    The matcher is run by SQLite against the catalogue columns, so no record
+    is decoded and each field is checked once no matter how many patterns
+    were combined into it.
+    '''
+    conn.create_function('spkg_match', 1, matcher)
+    condition = ' OR '.join(f'spkg_match({field})' for field in fields)
+    rows = conn.execute(f'SELECT name FROM packages WHERE {condition}\
+ ORDER BY name')
+
+    return [row[0] for row in rows]
+
+
+def scan_search(patterns: list[str], search_comments: bool,
+                search_descriptions: bool, exact: bool, db_dir: pathlib.Path,
+                regex: bool, glob: bool, jobs: int) -> list[str]:
+    '''Search pkgdb.yaml directly, spread over a pool of processes.
+
+    The file is split into ranges ending on line boundaries, and each range
+    is scanned by its own process. Every range comes back sorted, so merging
+    them keeps the names in alphabetical order.
+    '''
+    # Catalogue column names mapped to the keys used in pkgdb.yaml.
+    fields: list[str] = ['name']
+    if search_comments:
+        fields.append('comment')
+    if search_descriptions:
+        fields.append('desc')
+
+    path = pathlib.Path(db_dir, PKGDB_FILE)
+    ranges = split_lines(path, jobs * 4)
+    # Fail on a bad pattern here rather than in every worker.
+    make_matcher(patterns, exact, regex, glob)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(scan_range,
+                           *zip(*[(path, start, end, patterns, fields,
+                                   (exact, regex, glob))
+                                  for start, end in ranges]))
+
+        return list(heapq.merge(*results))
+
+
+def split_lines(path: pathlib.Path, count: int) -> list[tuple[int, int]]:
+    '''Split a file into roughly count ranges, each ending after a newline.'''
+    size = path.stat().st_size
+    if not size:
+        return []
+
+    ranges: list[tuple[int, int]] = []
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start: int = 0
+        step: int = max(size // count, 1)
+        while start < size:
+            end = mm.find(b'\n', min(start + step, size - 1)) + 1
+            if not end:
+                end = size
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def scan_range(path: pathlib.Path, start: int, end: int, patterns: list[str],
+               fields: list[str], mode: tuple[bool, bool, bool]) -> list[str]:
+    '''Return the sorted names of matching packages in part of pkgdb.yaml.'''
+    exact, regex, glob = mode
+    matcher = make_matcher(patterns, exact, regex, glob)
+
+    # Plain patterns must appear somewhere in the raw line to match, which
+    # lets most lines be skipped without decoding them. Patterns that JSON
+    # would escape cannot be checked this way.
+    needles: list[bytes] = []
+    if not regex and not glob and \
+            all(json.dumps(p)[1:-1] == p for p in patterns):
+        needles = [p.encode() for p in patterns]
+
+    names: list[str] = []
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        while mm.tell() < end:
+            line = mm.readline()
+            if needles and not any(needle in line for needle in needles):
+                continue
+
             data: dict[str, Any] = json.loads(line)
-            for pattern in patterns:
-                if not exact:
-                    if pattern in data['name']:
-                        hits.append(data)
-                        break
-                    if search_comments and pattern in data['comment']:
-                        hits.append(data)
-                        break
-                    if search_descriptions and pattern in data['description']:
-                        hits.append(data)
-                        break
-                else:
-                    if pattern == data['name']:
-                        hits.append(data)
-                        break
-                    if search_comments and pattern == data['comment']:
-                        hits.append(data)
-                        break
-                    if search_descriptions and pattern == data['description']:
-                        hits.append(data)
-                        break
-
-    return hits
-
-
-def display_results(results: list[Any], display_dependents: bool,
+            if any(matcher(data.get(field, '')) for field in fields):
+                names.append(data['name'])
+
+    return sorted(names)
+
+
+def make_phrase_query(fields: list[str], pattern: str) -> str:
+    '''Build an FTS5 query matching pattern as a substring of any field.'''
+    phrase = pattern.replace('"', '""')
+
+    return f'{{{" ".join(fields)}}} : "{phrase}"'
+
+
+def display_results(results: Iterable[Package], display_dependents: bool,
                     display_origins: bool, display_prefix: bool,
                     display_size: bool):
-    out = ""
+    '''Print the results, each one as soon as it is formatted.'''
     fmt_str = '{:16} : {}\n'
     for result in results:
+        out: list[str] = []
         # Displaying is done in a very specific order:
         # First we always display the package name, however, the output is
         # based on whether or not certain arguments are passed.
@@ -63,10 +260,10 @@ def display_results(results: list[Any], display_dependents: bool,
             # Origin and normal display always show package name/origin and
             # the package comment.
             if display_origins:
-                out += f"{result['origin']:<26} {result['comment']}\n"
+                print(f"{result.origin:<26} {result.comment}")
             else:
-                out += f"{result['name']+'-'+result['version']:<30}\
- {result['comment']}\n"
+                print(f"{result.name+'-'+result.version:<30}\
+ {result.comment}")
 
             continue
 
@@ -80,32 +277,30 @@ def display_results(results: list[Any], display_dependents: bool,
         # position (as seen above).
 
         # Start with the name
-        out += result['origin'] if display_origins else \
-            result['name']+'-'+result['version']
-        out += '\n'
+        out.append(result.origin if display_origins else
+                   result.name+'-'+result.version)
+        out.append('\n')
 
         # Prefix?
         if display_prefix:
-            out += fmt_str.format('Prefix', result['prefix'])
+            out.append(fmt_str.format('Prefix', result.prefix))
 
         # Comment
-        out += fmt_str.format('Comment', result['comment'])
+        out.append(fmt_str.format('Comment', result.comment))
 
         # Size?
         if display_size:
-            out += fmt_str.format('Flat size', size_fmt(result['flatsize']))
+            out.append(fmt_str.format('Flat size', size_fmt(result.flatsize)))
 
-        # Dependents?
+        # Dependencies?
         if display_dependents:
-            # This is the most complex, logically.
-            # We need to find all packages that have this package as a
-            # dependent, so we need to go back through the package database and
-            # search through everything.
-            deps: dict[str, Any] = result.get('deps', {})
+            # The dependencies are part of the package's own record, the
+            # reverse (packages depending on this one) is `info -r`.
+            deps: dict[str, Any] = result.deps
             if deps:
-                out += fmt_str.format('Depends on', '')
+                out.append(fmt_str.format('Depends on', ''))
 
                 for name, dep in deps.items():
-                    out += f"\t{name}-{dep['version']}\n"
+                    out.append(f"\t{name}-{dep['version']}\n")
 
-    print(out.strip())
+        print(''.join(out), end='')
@@ -0,0 +1,219 @@
+'''
+Query daemon keeping catalogues open between commands.
+
+`spkg serve` listens on a Unix socket and answers requests with the catalogue
+connections and the package record cache kept warm, so short lived callers
+pay neither the start up of spkg nor the reload of a catalogue.
+
+Requests and responses are JSON objects, one per line. A connection may send
+any number of requests, each is answered in turn with either
+{"ok": true, "result": ...} or {"ok": false, "error": "..."}. Every request has
+a "command" and may select a catalogue through "freebsd_version", "arch" and
+"release_type", the daemon's own catalogue is used otherwise.
+
+- {"command": "info", "packages": [...], "fields": [...]}: the records of
+  the packages, only the listed fields if any are given.
+- {"command": "search", "patterns": [...], "comment": false,
+  "description": false, "exact": false, "regex": false, "glob": false}: the
+  names of the matching packages.
+- {"command": "closure", "packages": [...]}: the name, version, size and
+  checksum of the packages and all of their dependencies, every package
+  after its dependencies.
+- {"command": "cli", "args": {...}}: the "stdout", "stderr" and exit
+  "status" of an info, search or which-lib command, given its parsed
+  arguments. Used by `spkg --server`.
+'''
+
+from __future__ import annotations
+from argparse import Namespace
+from typing import Any
+import contextlib
+import copy
+import importlib
+import io
+import json
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from appdirs import AppDirs
+import pkgdb
+from pkgdb import PKGDB_FILE
+from util import Config, COMMANDS, invalidate_package_cache, \
+    read_package_data
+
+SOCKET_FILE = 'spkg.sock'
+
+# Commands the CLI can hand over to a running daemon.
+CLIENT_COMMANDS = {'info', 'search', 'which-lib'}
+
+
+def get_socket_path(appdirs: AppDirs) -> pathlib.Path:
+    return pathlib.Path(appdirs.user_cache_dir, SOCKET_FILE)
+
+
+def run(args: Namespace, config: Config, appdirs: AppDirs):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise Exception('spkg serve needs Unix domain sockets, which are not\
+ supported on this platform.')
+
+    path = pathlib.Path(args.socket) if args.socket \
+        else get_socket_path(appdirs)
+    if path.exists():
+        # Left behind unless another daemon is still answering on it.
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(str(path))
+            except OSError:
+                path.unlink()
+            else:
+                raise Exception(f'spkg serve is already running on {path}')
+
+    server = Server(str(path), config, appdirs)
+    # Stop the same way on a kill as on Ctrl+C, removing the socket.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    print(f'Serving on {path}, press Ctrl+C to stop.', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        path.unlink(missing_ok=True)
+
+
+def request(path: pathlib.Path, message: dict[str, Any]) -> Any:
+    '''Send a request to a running daemon and return its result.'''
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError as e:
+            raise Exception(f'Unable to reach spkg serve on {path}: {e}')\
+                from e
+
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(message).encode() + b'\n')
+            f.flush()
+            response: dict[str, Any] = json.loads(f.readline())
+
+    if not response['ok']:
+        raise Exception(response['error'])
+
+    return response['result']
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Answer requests against catalogues that are kept open.
+
+    Connections are handled by their own threads, but requests are answered
+    one at a time as they share the catalogue connections.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path: str, config: Config, appdirs: AppDirs):
+        super().__init__(path, RequestHandler)
+        self.config = config
+        self.appdirs = appdirs
+        self.lock = threading.Lock()
+        self._stamps: dict[pathlib.Path, tuple[int, int]] = {}
+
+    def answer(self, message: dict[str, Any]) -> Any:
+        config = self.get_config(message)
+        with self.lock:
+            self.check_catalogue(config)
+
+            command = message.get('command')
+            if command == 'info':
+                return self.info(message, config)
+            if command == 'search':
+                import search
+                db_dir = config.get_catalogue_dir(self.appdirs)
+                return search.begin_search(
+                    message['patterns'], message.get('comment', False),
+                    message.get('description', False),
+                    message.get('exact', False), db_dir,
+                    message.get('regex', False), message.get('glob', False))
+            if command == 'closure':
+                # Imported on first use as fetch pulls in requests.
+                import fetch
+                return [{field: getattr(pkg, field)
+                         for field in fetch.SUMMARY_FIELDS}
+                        for pkg in fetch.resolve_deps(message['packages'],
+                                                      self.appdirs, config)]
+            if command == 'cli':
+                return self.cli(message['args'], config)
+
+        raise Exception(f'Unknown command: {command}')
+
+    def info(self, message: dict[str, Any],
+             config: Config) -> list[dict[str, Any]]:
+        fields: list[str] = message.get('fields', [])
+        if fields:
+            return list(pkgdb.read_fields(
+                config.get_catalogue_dir(self.appdirs), fields,
+                message['packages']))
+
+        records = [read_package_data(name, config, self.appdirs)
+                   for name in message['packages']]
+        return [record for record in records if record]
+
+    def cli(self, args: dict[str, Any], config: Config) -> dict[str, Any]:
+        if args['command'] not in CLIENT_COMMANDS:
+            raise Exception(f'{args["command"]} cannot be run by spkg serve')
+
+        out = io.StringIO()
+        err = io.StringIO()
+        status: Any = 0
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                importlib.import_module(COMMANDS[args['command']]).run(
+                    Namespace(**args), config, self.appdirs)
+            except SystemExit as e:
+                status = e.code
+
+        return {'stdout': out.getvalue(), 'stderr': err.getvalue(),
+                'status': status}
+
+    def get_config(self, message: dict[str, Any]) -> Config:
+        '''Return the configuration selecting the requested catalogue.'''
+        config = copy.copy(self.config)
+        if message.get('freebsd_version'):
+            config.freebsd_version = message['freebsd_version']
+        if message.get('arch'):
+            config.architecture = message['arch']
+        if message.get('release_type'):
+            config.release_type = message['release_type']
+
+        return config
+
+    def check_catalogue(self, config: Config):
+        '''Drop what was read from a catalogue that has since been updated.'''
+        db_dir = config.get_catalogue_dir(self.appdirs)
+        try:
+            stat = os.stat(pathlib.Path(db_dir, PKGDB_FILE))
+        except FileNotFoundError as e:
+            raise Exception(f'No package database for {config.abi}/\
+{config.release_type}, run spkg update first.') from e
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if self._stamps.get(db_dir, stamp) != stamp:
+            invalidate_package_cache(db_dir)
+        self._stamps[db_dir] = stamp
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    server: Server
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                response = {'ok': True, 'result': self.server.answer(message)}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e) or repr(e)}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
@@ -0,0 +1,149 @@
+'''
+Content-addressed store of downloaded packages.
+
+Every package is downloaded once into the store, named after the SHA-256
+checksum recorded in the catalogue, and hardlinked from there into whichever
+directory it was fetched to. Fetching the same package into several
+directories, or for several ABIs, then costs neither bandwidth nor extra disk
+space. Links fall back to copies where the file system does not support them.
+
+The store is kept under a size limit by removing the packages that were least
+recently fetched. The modification time of a stored file records its last use.
+Directories on another file system than the store are fetched to directly, as
+they could only be given copies.
+
+Several spkg processes may share the store. A package is only downloaded,
+linked or removed while holding the lock named after its checksum.
+'''
+
+from __future__ import annotations
+from typing import ContextManager
+import os
+import pathlib
+import shutil
+import time
+from appdirs import AppDirs
+import locks
+
+STORE_DIR = 'store'
+# Seconds after which an unfinished download in the store is given up on.
+STALE_PART_AGE = 7 * 24 * 60 * 60
+
+
+def get_store_dir(appdirs: AppDirs) -> pathlib.Path:
+    return pathlib.Path(appdirs.user_cache_dir, STORE_DIR)
+
+
+def get_path(store_dir: pathlib.Path, checksum: str) -> pathlib.Path:
+    '''Return where the package with the given checksum is stored.
+
+    Packages are spread over subdirectories by the first two characters of
+    their checksum, keeping every directory reasonably small.
+    '''
+    return pathlib.Path(store_dir, checksum[:2], checksum + '.pkg')
+
+
+def link(stored: pathlib.Path, dest: pathlib.Path):
+    '''Place a stored package at dest, replacing any file already there.
+
+    The stored file is marked as used.
+    '''
+    tmp_path = pathlib.Path(dest.parent, dest.name + '.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    try:
+        os.link(stored, tmp_path)
+    except OSError:
+        # Different file systems, or no hardlink support at all.
+        shutil.copyfile(stored, tmp_path)
+    os.replace(tmp_path, dest)
+
+    touch(stored)
+
+
+def touch(stored: pathlib.Path):
+    os.utime(stored)
+
+
+def can_link(store_dir: pathlib.Path, dest_dir: pathlib.Path) -> bool:
+    '''Check whether stored packages can be hardlinked into dest_dir.
+
+    Links only work within a file system, elsewhere the store would cost
+    the space of every package a second time.
+    '''
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    return store_dir.stat().st_dev == dest_dir.stat().st_dev
+
+
+def get_lock_path(stored: pathlib.Path) -> pathlib.Path:
+    return stored.with_suffix('.lock')
+
+
+def lock(stored: pathlib.Path, blocking: bool = True,
+         remove: bool = False) -> ContextManager[bool]:
+    '''Hold the exclusive lock of a stored package, see locks.hold.'''
+    return locks.hold(get_lock_path(stored), blocking, remove)
+
+
+def collect_garbage(store_dir: pathlib.Path, max_bytes: int) -> int:
+    '''Remove the least recently used packages until the store fits max_bytes.
+
+    Unfinished downloads count towards max_bytes, but are left alone so they
+    can still be resumed unless untouched for STALE_PART_AGE seconds. Lock
+    files of packages no longer stored are removed as well. Nothing is
+    removed while another process holds its lock. Returns the number of
+    bytes freed.
+    '''
+    if not store_dir.exists():
+        return 0
+
+    now = time.time()
+    entries: list[tuple[float, int, pathlib.Path]] = []
+    total: int = 0
+    freed: int = 0
+    for path in store_dir.glob('*/*'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Removed by another process collecting garbage.
+            continue
+
+        if path.suffix == '.pkg':
+            entries.append((stat.st_mtime, stat.st_size, path))
+        elif path.suffix == '.part':
+            if now - stat.st_mtime > STALE_PART_AGE and \
+                    _remove(path.with_suffix(''), path):
+                freed += stat.st_size
+        elif path.suffix == '.lock':
+            stored = path.with_suffix('.pkg')
+            if not stored.exists() and not _get_part_path(stored).exists():
+                _remove(stored)
+        total += stat.st_size
+
+    for _, size, path in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        if _remove(path, path):
+            freed += size
+
+    return freed
+
+
+def _remove(stored: pathlib.Path, *paths: pathlib.Path) -> bool:
+    '''Remove files of a stored package along with its lock file.
+
+    Returns False, removing nothing, if another process holds the lock.
+    '''
+    with lock(stored, blocking=False, remove=True) as taken:
+        if not taken:
+            return False
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    return True
+
+
+def _get_part_path(stored: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(stored.parent, stored.name + '.part')
@@ -0,0 +1,107 @@
+'''
+Shared HTTP session for every request made to the package repository.
+
+Reusing one session keeps connections to the repository alive between
+requests, instead of paying for a new TCP (and TLS) handshake per file.
+'''
+
+from __future__ import annotations
+from typing import Optional
+from urllib.parse import urlsplit
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from util import Config
+
+# Responses worth retrying, the server is either overloaded or restarting.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_SESSION: dict[str, requests.Session] = {}
+_HOST_SLOTS: dict[str, threading.BoundedSemaphore] = {}
+_HOST_SLOTS_LOCK = threading.Lock()
+
+
+def get_session(config: Config) -> requests.Session:
+    '''Return the shared session, creating it on first use.
+
+    The connection pool, retries and backoff are taken from config the first
+    time the session is created.
+    '''
+    if 'session' in _SESSION:
+        return _SESSION['session']
+
+    retry = Retry(total=config.retries, backoff_factor=config.backoff,
+                  status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=config.pool_size,
+                          pool_maxsize=config.pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.headers['User-Agent'] = f'{Config.APP_NAME}/{Config.VERSION}'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _SESSION['session'] = session
+
+    return session
+
+
+def get(config: Config, url: str, **kwargs) -> requests.Response:
+    '''Send a GET request through the shared session.'''
+    kwargs.setdefault('timeout', config.timeout)
+
+    return get_session(config).get(url, **kwargs)
+
+
+def host_slot(config: Config,
+              url: str) -> Optional[threading.BoundedSemaphore]:
+    '''Return the semaphore limiting concurrent requests to url's host.
+
+    Returns None when config sets no limit. Hold the semaphore for as long as
+    the response is being read.
+    '''
+    if not config.host_connections:
+        return None
+
+    host = urlsplit(url).netloc
+    with _HOST_SLOTS_LOCK:
+        if host not in _HOST_SLOTS:
+            _HOST_SLOTS[host] = threading.BoundedSemaphore(
+                config.host_connections)
+
+        return _HOST_SLOTS[host]
+
+
+class TokenBucket():
+    '''Limit the combined rate of transfers shared between threads.
+
+    Every thread takes tokens, one per byte, before using them. The bucket
+    holds at most a second's worth, so idle time cannot be saved up into a
+    burst above the rate.
+    '''
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._tokens: float = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last) * self.rate,
+                               self.rate)
+            self._last = now
+
+            # Going into debt makes later callers wait for it to be paid off.
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+def close():
+    '''Close the shared session and all of its pooled connections.'''
+    if 'session' in _SESSION:
+        _SESSION.pop('session').close()
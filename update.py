@@ -4,72 +4,147 @@ TODO: Implement -r arg
 '''
 
 from __future__ import annotations
+import copy
 import tarfile
 import pathlib
-import tempfile
-import shutil
 from argparse import Namespace
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import requests
 from appdirs import AppDirs
-from util import Config
+import pkgdb
+import transport
+from pkgdb import PKGDB_FILE
+from util import Config, CATALOGUES_DIR, invalidate_package_cache
 
 
-def run(_args: Namespace, config: Config, appdirs: AppDirs):
-    cache_dir = pathlib.Path(appdirs.user_cache_dir)
-    if not cache_dir.exists():
-        cache_dir.mkdir()
-    tmpdir = pathlib.Path(tempfile.gettempdir(), 'spkg')
-    tmpdir.mkdir(parents=True, exist_ok=True)
+def run(args: Namespace, config: Config, appdirs: AppDirs):
+    if not args.all_abis:
+        update_catalogue(config, appdirs, args.force)
+        print('Update complete!')
+        return
 
-    tar_path = pathlib.Path(tmpdir, 'packagesite.txz')
+    configs = find_catalogues(config, appdirs)
+    failed: list[tuple[str, Exception]] = []
 
-    # Ensure there is a packagesite.yaml for this ABI
+    # Each catalogue is downloaded and loaded by its own thread, their output
+    # is told apart by the ABI and release type it starts with.
+    with ThreadPoolExecutor(max_workers=len(configs)) as pool:
+        futures: dict[Future[None], str] = {}
+        for catalogue in configs:
+            label = f'{catalogue.abi}/{catalogue.release_type}'
+            futures[pool.submit(update_catalogue, catalogue, appdirs,
+                                args.force, f'{label}: ')] = label
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append((futures[future], e))
+
+    if failed:
+        print(f'Unable to update {len(failed)} catalogue(s):')
+        for name, error in sorted(failed, key=lambda fail: fail[0]):
+            print(f'\t{name}: {error}')
+        return
+
+    print('Update complete!')
+
+
+def update_catalogue(config: Config, appdirs: AppDirs, force: bool,
+                     label: str = ''):
+    '''Download the catalogue of config's ABI and release type.
+
+    Every line printed starts with label.
+    '''
+    db_dir = config.get_catalogue_dir(appdirs)
+    if not db_dir.exists():
+        db_dir.mkdir(parents=True)
+
+    # Only download the catalogue if it changed since the last update.
+    headers: dict[str, str] = {}
+    if not force and pkgdb.is_current(db_dir):
+        headers = get_conditional_headers(pkgdb.read_meta(db_dir))
+
+    # packagesite.txz is never written to disk: the response is decompressed
+    # and untarred as it arrives, and packagesite.yaml is fed line by line
+    # into the package database.
     url = config.get_full_url()
-    print('Downloading packagesite.txz...')
-    with requests.get(url.format('packagesite.txz')) as r:
+    log('Downloading packagesite.txz...', label)
+    with transport.get(config, url.format('packagesite.txz'),
+                       headers=headers, stream=True) as r:
+        if r.status_code == requests.codes.not_modified:
+            log('Package database is already up to date.', label)
+            return
         r.raise_for_status()
-        with open(pathlib.Path(tar_path), 'wb') as f:
-            for chunk in r.iter_content():
-                if chunk:
-                    f.write(chunk)
-                    # f.flush()
-                    # os.fsync(f.fileno())
-    print('packagesite.txz downloaded.')
-    print('Extracting...')
-    with tarfile.open(tar_path, 'r:xz') as f:
-        
-        import os
-        
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(f, tmpdir)
-
-    print('packagesite.txz extracted.')
-
-    # Verification would be done here
-    # print('Verifying packagesite.yaml')
-
-    print('Generating package database...')
-    shutil.copy(pathlib.Path(tmpdir, 'packagesite.yaml'),
-                pathlib.Path(cache_dir, 'pkgdb.yaml'))
-    print('Package database generated.')
-    print('Cleaning up...')
-    shutil.rmtree(tmpdir)
-    print('Update complete!')
+        r.raw.decode_content = True
+
+        meta: dict[str, str] = {
+            'etag': r.headers.get('ETag', ''),
+            'last_modified': r.headers.get('Last-Modified', '')
+        }
+
+        with tarfile.open(fileobj=r.raw, mode='r|xz',
+                          bufsize=config.chunk_size) as tar:
+            for member in tar:
+                if member.name != 'packagesite.yaml':
+                    continue
+
+                # Verification would be done here
+                # print('Verifying packagesite.yaml')
+
+                log('Updating package database...', label)
+                invalidate_package_cache(db_dir)
+                changes = pkgdb.build(db_dir, tar.extractfile(member), meta)
+                log(f'Package database updated: {changes["added"]} added,\
+ {changes["changed"]} changed, {changes["removed"]} removed.', label)
+                break
+            else:
+                raise Exception('packagesite.txz does not contain\
+ packagesite.yaml')
+
+
+def log(message: str, label: str = ''):
+    # A single write, so lines from concurrent updates are never mixed up.
+    print(f'{label}{message}\n', end='', flush=True)
+
+
+def find_catalogues(config: Config, appdirs: AppDirs) -> list[Config]:
+    '''Return a configuration for every catalogue downloaded so far.
+
+    The catalogue selected by config is always included, and every returned
+    configuration shares its transport settings.
+    '''
+    configs: dict[pathlib.Path, Config] = {
+        config.get_catalogue_dir(appdirs): config
+    }
+
+    root = pathlib.Path(appdirs.user_cache_dir, CATALOGUES_DIR)
+    for yaml_path in sorted(root.glob(f'*/*/{PKGDB_FILE}')):
+        release_dir = yaml_path.parent
+        try:
+            _, version, arch = release_dir.parent.name.split('-')
+            catalogue = copy.copy(config)
+            catalogue.freebsd_version = int(version)
+            catalogue.architecture = arch
+            catalogue.release_type = release_dir.name
+        except Exception:
+            # Not a directory created by spkg, or no longer supported.
+            continue
+        configs.setdefault(catalogue.get_catalogue_dir(appdirs), catalogue)
+
+    return list(configs.values())
+
+
+def get_conditional_headers(meta: dict[str, str]) -> dict[str, str]:
+    '''Build the validators for a conditional request of packagesite.txz.'''
+    headers: dict[str, str] = {}
+
+    etag = meta.get('etag')
+    if etag:
+        headers['If-None-Match'] = etag
+
+    last_modified = meta.get('last_modified')
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    return headers
@@ -1,7 +1,12 @@
-from typing import Any
+from __future__ import annotations
+from typing import Any, Hashable, Iterable, Iterator, Optional
+from collections import OrderedDict
 import json
 import pathlib
+import threading
 from appdirs import AppDirs
+import pkgdb
+from pkgdb import PKGDB_FILE
 
 
 def size_fmt(num: float, do_round: bool = False) -> str:
@@ -16,6 +21,22 @@ def size_fmt(num: float, do_round: bool = False) -> str:
     return f'{round(num)}GiB'
 
 
+# Directory under the user cache directory holding one catalogue per ABI and
+# release type.
+CATALOGUES_DIR = 'catalogues'
+
+# The module running each command. Modules are only imported once their
+# command is run, so local queries never pay for importing requests.
+COMMANDS = {
+    'update': 'update',
+    'fetch': 'fetch',
+    'info': 'info',
+    'search': 'search',
+    'which-lib': 'which_lib',
+    'serve': 'serve'
+}
+
+
 class Config():
     AUTHOR = 'BastIsAwesome'
     APP_NAME = 'spkg'
@@ -35,6 +56,24 @@ class Config():
         self._architecture = 'amd64'
         self._release_type = 'quarterly'
 
+        # HTTP transport settings.
+        self.pool_size: int = 10
+        self.timeout: float = 30.0
+        self.retries: int = 3
+        self.backoff: float = 0.5
+        self.chunk_size: int = 256 * 1024
+        # Limits of downloads, in bytes a second across every download and in
+        # connections to a single host. 0 means no limit.
+        self.rate_limit: int = 0
+        self.host_connections: int = 0
+
+        # Limits of the decoded package record cache.
+        self.cache_records: int = 1024
+        self.cache_bytes: int = 16 * 1024 * 1024
+
+        # Size limit of the shared store of downloaded packages.
+        self.store_bytes: int = 10 * 1024 * 1024 * 1024
+
     def get_full_url(self):
         '''Return the full URL to the repo.
 
@@ -84,36 +123,197 @@ class Config():
     def abi(self):
         return f'FreeBSD:{self.freebsd_version}:{self.architecture}'
 
+    def get_catalogue_dir(self, appdirs: AppDirs) -> pathlib.Path:
+        '''Return the directory holding the catalogue of this ABI and release.
 
-_PKG_CACHE: dict[str, dict[str, Any]] = {}
-_pkg_cache_pos: int = 0
+        Each ABI and release type has its own package database, so switching
+        between them never overwrites another one. The colons in the ABI are
+        not allowed in Windows paths, so they are replaced.
+        '''
+        return pathlib.Path(appdirs.user_cache_dir, CATALOGUES_DIR,
+                            self.abi.replace(':', '-'), self._release_type)
 
 
-def read_package_data(pkg_name: str, _config: Config,
-                      appdirs: AppDirs) -> dict[str, Any]:
-    if pkg_name in _PKG_CACHE:
-        return _PKG_CACHE[pkg_name]
+class RecordCache():
+    '''Least-recently-used cache of decoded package records.
+
+    The cache is bounded both by the number of records and by their total
+    size, measured as the length of each record's line in pkgdb.yaml.
+    '''
+
+    def __init__(self, max_records: int = 1024,
+                 max_bytes: int = 16 * 1024 * 1024):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.size: int = 0
+        self._records: OrderedDict[Hashable, tuple[dict[str, Any], int]] = \
+            OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
 
-    global _pkg_cache_pos  # pylint: disable=global-statement
+    def get(self, key: Hashable) -> Optional[dict[str, Any]]:
+        with self._lock:
+            if key not in self._records:
+                self.misses += 1
+                return None
 
-    data: dict[str, Any] = {}
-    with open(pathlib.Path(appdirs.user_cache_dir, 'pkgdb.yaml'), 'r') as f:
-        f.seek(_pkg_cache_pos)
-        line = f.readline()
+            self.hits += 1
+            self._records.move_to_end(key)
+            return self._records[key][0]
 
-        while line:
-            data = json.loads(line)
-            _PKG_CACHE[data['name']] = data
+    def put(self, key: Hashable, record: dict[str, Any], size: int):
+        with self._lock:
+            if key in self._records:
+                self.size -= self._records.pop(key)[1]
+            self._records[key] = (record, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, max_records: int, max_bytes: int):
+        with self._lock:
+            self.max_records = max_records
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self._records and (len(self._records) > self.max_records or
+                                 self.size > self.max_bytes):
+            self.size -= self._records.popitem(last=False)[1][1]
+
+
+PKG_CACHE = RecordCache()
+
+
+def invalidate_package_cache(db_dir: Optional[pathlib.Path] = None):
+    '''Forget any records read from the old database.
+
+    Without db_dir the connections to every catalogue are closed.
+    '''
+    PKG_CACHE.clear()
+    pkgdb.close(db_dir)
+
+
+def read_package_data(pkg_name: str, config: Config,
+                      appdirs: AppDirs) -> dict[str, Any]:
+    PKG_CACHE.resize(config.cache_records, config.cache_bytes)
 
-            if data['name'] == pkg_name:
-                _pkg_cache_pos = f.tell()
-                break
+    # The same package name can be in several catalogues.
+    db_dir = config.get_catalogue_dir(appdirs)
+    key = (str(db_dir), pkg_name)
+    data = PKG_CACHE.get(key)
+    if data is not None:
+        return data
 
-            line = f.readline()
+    location = pkgdb.get_location(pkgdb.connect(db_dir), pkg_name)
+    if not location:
+        return {}
+
+    offset, length = location
+    with open(pathlib.Path(db_dir, PKGDB_FILE), 'rb') as f:
+        f.seek(offset)
+        data = json.loads(f.read(length))
+
+    PKG_CACHE.put(key, data, length)
 
     return data
 
 
+class Package():
+    '''A package from the package database.
+
+    Only the fields a command asks for are read up front. Any other field is
+    loaded the first time it is accessed, list-valued fields from the
+    catalogue tables and everything else from the package's full record,
+    which is then kept. Slotted fields missing from a package's record are
+    None, any other missing field raises AttributeError. A package created
+    with its full record reads every field from it.
+    '''
+    __slots__ = ('name', 'version', 'origin', 'pkgsize', 'flatsize',
+                 'comment', 'prefix', 'desc', 'sum', 'deps',
+                 'shlibs_required', 'shlibs_provided', 'categories',
+                 'annotations', '_config', '_appdirs', '_record')
+
+    def __init__(self, fields: dict[str, Any], config: Config,
+                 appdirs: AppDirs, record: Optional[dict[str, Any]] = None):
+        for field, value in fields.items():
+            setattr(self, field, value)
+        self._config = config
+        self._appdirs = appdirs
+        self._record = record
+
+    def __getattr__(self, field: str) -> Any:
+        # Only called for fields that have not been loaded yet.
+        if field.startswith('_'):
+            raise AttributeError(field)
+
+        if field in pkgdb.TABLE_FIELDS and (self._record is None
+                                            or field not in self._record):
+            db_dir = self._config.get_catalogue_dir(self._appdirs)
+            value = pkgdb.read_table_field(pkgdb.connect(db_dir), self.name,
+                                           field)
+        else:
+            if self._record is None:
+                self._record = read_package_data(self.name, self._config,
+                                                 self._appdirs)
+            if field not in self._record and field not in Package.__slots__:
+                raise AttributeError(field)
+            value = self._record.get(field)
+
+        if field in Package.__slots__:
+            setattr(self, field, value)
+
+        return value
+
+    def __repr__(self) -> str:
+        return f'Package({self.name}-{self.version})'
+
+
+def read_packages(pkg_names: Optional[list[str]], fields: list[str],
+                  config: Config, appdirs: AppDirs) -> list[Package]:
+    '''Read packages from the package database, preloading fields.
+
+    Packages are returned in the order of pkg_names, leaving out unknown
+    names. With pkg_names as None every package is returned, in alphabetical
+    order.
+    '''
+    return list(iter_packages(pkg_names, fields, config, appdirs))
+
+
+def iter_packages(pkg_names: Optional[list[str]], fields: Optional[list[str]],
+                  config: Config, appdirs: AppDirs,
+                  by_offset: bool = False) -> Iterator[Package]:
+    '''Read packages one at a time, see read_packages.
+
+    With fields as None, every package is read with its full record. With
+    by_offset, packages come in the order of pkg_names' records in pkgdb.yaml,
+    which is read from front to back.
+    '''
+    db_dir = config.get_catalogue_dir(appdirs)
+    if fields is None:
+        for record in pkgdb.read_fields(db_dir, None, pkg_names, by_offset):
+            yield Package({'name': record['name']}, config, appdirs, record)
+        return
+
+    preload = ['name'] + [field for field in fields
+                          if field in Package.__slots__ and field != 'name']
+    for record in pkgdb.read_fields(db_dir, preload, pkg_names, by_offset):
+        yield Package(record, config, appdirs)
+
+
+def read_lines(lines: Iterable[str]) -> list[str]:
+    '''Return the non-blank lines, stripped of surrounding whitespace.'''
+    return [line.strip() for line in lines if line.strip()]
+
+
 def proceed_menu(prompt: str) -> bool:
     choice: str = ''
 
@@ -0,0 +1,20 @@
+from __future__ import annotations
+from argparse import Namespace
+from appdirs import AppDirs
+import pkgdb
+from util import Config
+
+
+def run(args: Namespace, config: Config, appdirs: AppDirs):
+    conn = pkgdb.connect(config.get_catalogue_dir(appdirs))
+    providers = pkgdb.get_providers(conn, args.soname)
+
+    out = ''
+    for soname, packages in providers.items():
+        out += f'{soname}:\n'
+        if not packages:
+            out += '\tNot provided by any package\n'
+        for name, version in packages:
+            out += f'\t{name}-{version}\n'
+
+    print(out.strip())